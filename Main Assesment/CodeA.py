@@ -32,44 +32,56 @@ Default_Params = {"Aspiration_Rate": 1.0,               # Global parameter for a
                   "Touch_Tip_Speed": 20,                # These three parameters determine the properties of the touch tip function which removes droplets from pipette tips following mixing and prior to dilution.
                   "Touch_Tip_Radius": 0.8,              
                   "Touch_Tip_V_Offset": -1.0,           # Determines the height of the tip during the touch tips step.
-                  }
-
-import csv
-from textwrap import dedent
-
-DESIGN_CSV = "/Users/mattgroves/Documents/GitHub/ssb_s5/Main Assesment/Full Factorial.txt"  # Loads the CSV file of the JMP design 
-
-def make_protocol_code(params: dict, experiment_id: str): # Defines the protocol-maker function
-    
-    params_literal = repr(params) # Converts params dictionary to a string called params_literal
-
-# The following is the template code which is described as Code B in the pseudo code. This is returned by the function with the correct params dictionary.
-
-    return dedent(f""" 
-    
-    import random
-    from opentrons import protocol_api
 
-    metadata = {{
-        "apiLevel": "2.15",
-        "protocolName": "Serial Dilutions (PB exp {experiment_id})",
-        "description": "Serial dilution with parameters from PB experiment {experiment_id}",
-        "author": "Wilson et al"
-    }}
+                  "Aliquot_Dispenses_Per_Aspirate": 1,  # Number of plate columns filled with PBS from each aspiration. 1 aspirates for every column. 2 fills two columns per trip to the reservoir (multi-dispense).
+                  "Aliquot_Disposal_Volume": 20.0,      # Extra PBS (uL) aspirated in multi-dispense mode which is not dispensed into the plate. It is blown out into the waste after the last column.
+                  }
 
-    PARAMS = {params_literal}
+import hashlib
+import json
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from textwrap import dedent, indent
 
-    def run(protocol: protocol_api.ProtocolContext):
+import numpy as np
+import pandas as pd
 
-        plate = protocol.load_labware('costar3370flatbottomtransparent_96_wellplate_200ul', 3)
-        tiprack_1 = protocol.load_labware('opentrons_96_tiprack_300ul', 1)
-        p300 = protocol.load_instrument('p300_multi_gen2', 'left', tip_racks=[tiprack_1])
-        reservoir = protocol.load_labware('4ti0136_96_wellplate_2200ul', 2)
-
-        p300.flow_rate.aspirate = 80
-        p300.flow_rate.dispense = 40
-        p300.flow_rate.blow_out = 150
+DESIGN_CSV = "/Users/mattgroves/Documents/GitHub/ssb_s5/Main Assesment/Full Factorial.txt"  # Loads the CSV file of the JMP design 
 
+PARALLEL_WORKERS = None  # Number of processes used by main_parallel. None uses every CPU core.
+BATCH_SIZE = 500         # Number of design rows held in memory and written at a time by main_parallel.
+MANIFEST_FILE = "protocol_manifest.json"  # Maps each experiment id to the hash and file of its protocol when main_cached is used.
+TABLE_PROTOCOL = "serial_dilution_BB_table.py"   # The fixed protocol written by main_table.
+TABLE_FILE = "serial_dilution_BB_params.csv"     # The parameter table written by main_table, given to the protocol as a runtime parameter.
+TABLE_MAX_EXPERIMENTS = 100000                   # Largest experiment id which can be chosen in the Opentrons App.
+
+SESSION_TIPRACK_SLOTS = [1, 4]                      # Deck slots for tip racks in multi-plate sessions (main_sessions). Each rack serves 4 experiments.
+SESSION_PLATE_SLOTS = [3, 5, 6, 7, 8, 9, 10, 11]    # Deck slots for plates in multi-plate sessions. The reservoir stays in slot 2.
+EXPERIMENTS_PER_SESSION = 8                         # At most len(SESSION_PLATE_SLOTS) and 4 * len(SESSION_TIPRACK_SLOTS).
+SESSION_PBS_COLUMNS = [6, 7, 8, 9, 10, 11, 2, 3, 4, 5]  # Reservoir columns filled with PBS for multi-plate sessions, used in this order.
+
+PLATE_ROWS = "ABCDEFGH"
+MULTIPLEX_FILE = "serial_dilution_BB_plate_{plate_id}.py"  # Protocols written by main_multiplex, one per plate.
+PLATE_MAP_FILE = "serial_dilution_BB_plate_map.csv"        # Written by main_multiplex: the plate and row of each experiment, for Code C.
+
+RESERVOIR_WELL_VOLUME = 2200   # uL, capacity of each reservoir well.
+PLATE_WELL_VOLUME = 200        # uL, capacity of each well of the costar 3370 plate.
+TIP_VOLUME = 300               # uL, capacity of the opentrons_96_tiprack_300ul tips.
+TIPRACK_COLUMNS = 12
+TOUCH_TIP_SPEED_RANGE = (1, 80) # mm/s, touch tip speeds allowed by the Opentrons API.
+RESERVOIR_DEAD_VOLUME = 100    # uL left in a reservoir well which the pipette cannot reach.
+PBS_PER_PLATE = 11 * 100       # uL of PBS taken from each reservoir well to fill one plate (11 columns x pbs_volume).
+
+INSTRUMENT = False                        # True writes protocols which log the time of each pipette step on the robot (see CodeB_timing.py).
+TIMING_DIR = "/data/user_storage/timings" # Directory on the OT-2 where instrumented protocols write their timing logs.
+
+# The following is the template code which is described as Code B in the pseudo code. The templates are built once when CodeA is loaded, and make_protocol_code only fills in the experiment id and params dictionary.
+# PROTOCOL_STEPS is the serial dilution of one plate. It is shared by the single experiment template and the multi-plate session template.
+
+PROTOCOL_STEPS = dedent("""
         fluorescein_volume = 200
         pbs_volume         = 100
         dilution_volume    = 100
@@ -101,15 +113,14 @@ def make_protocol_code(params: dict, experiment_id: str): # Defines the protocol
         touch_radius  = PARAMS["Touch_Tip_Radius"]
         touch_voffset = PARAMS["Touch_Tip_V_Offset"]
 
+        aliquot_per_asp = PARAMS["Aliquot_Dispenses_Per_Aspirate"]
+        disposal_volume = PARAMS["Aliquot_Disposal_Volume"]
+
         start_col = int(PARAMS["start_col"])
 
         base_mix_volume = dilution_volume + pbs_volume  
         mix_volume = base_mix_volume * mix_fraction
 
-        fluorescein_src = reservoir['A1']
-        pbs_src         = reservoir['A6']
-        waste           = reservoir['A12']
-
         fluor_tip_start = f"A{{start_col}}"
         pbs_tip_start   = f"A{{start_col + 1}}"
         dilution_tip_start   = f"A{{start_col + 2}}"
@@ -133,19 +144,38 @@ def make_protocol_code(params: dict, experiment_id: str): # Defines the protocol
         p300.drop_tip()
 
         p300.pick_up_tip(pbs_tip)
-        for col in range(2, 13):
-            dest = plate[f'A{{col}}']
-            p300.aspirate(
-                pbs_volume,
-                pbs_src.bottom(aliquot_asp_height),
-                rate=aliquot_asp_rate
-            )
-            p300.dispense(
-                pbs_volume,
-                dest.bottom(aliquot_disp_height),
-                rate=aliquot_disp_rate
-            )
-            p300.blow_out(dest.top())
+        if aliquot_per_asp > 1:
+            # Multi-dispense: each aspiration fills several columns. The disposal volume is only aspirated the first time. 
+            # It stays in the tip so every dispense is made from a partly full tip, and is blown out into the waste at the end.
+            pbs_cols = list(range(2, 13))
+            for i in range(0, len(pbs_cols), aliquot_per_asp):
+                cols = pbs_cols[i:i + aliquot_per_asp]
+                p300.aspirate(
+                    pbs_volume * len(cols) + (disposal_volume if i == 0 else 0),
+                    pbs_src.bottom(aliquot_asp_height),
+                    rate=aliquot_asp_rate
+                )
+                for col in cols:
+                    p300.dispense(
+                        pbs_volume,
+                        plate[f'A{{col}}'].bottom(aliquot_disp_height),
+                        rate=aliquot_disp_rate
+                    )
+            p300.blow_out(waste.top())
+        else:
+            for col in range(2, 13):
+                dest = plate[f'A{{col}}']
+                p300.aspirate(
+                    pbs_volume,
+                    pbs_src.bottom(aliquot_asp_height),
+                    rate=aliquot_asp_rate
+                )
+                p300.dispense(
+                    pbs_volume,
+                    dest.bottom(aliquot_disp_height),
+                    rate=aliquot_disp_rate
+                )
+                p300.blow_out(dest.top())
         p300.drop_tip()
 
         p300.pick_up_tip(dilution_tip)
@@ -194,98 +224,614 @@ def make_protocol_code(params: dict, experiment_id: str): # Defines the protocol
         p300.aspirate(100, plate['A11'], rate=dilution_asp_rate)
         p300.dispense(150, waste.bottom(), rate=2)
         p300.drop_tip()
-    """)
+""")
+
+# apiLevel 2.17 and later reject a dispense of more than the tip holds, so the apiLevel 2.20 templates (main_table and main_multiplex)
+# empty the tip into the waste with the 100 uL it aspirated. The 2.15 templates keep 150 uL, which the API clamps to the same 100 uL.
+WASTE_DISPENSE = ("p300.dispense(150, waste.bottom(), rate=2)", "p300.dispense(100, waste.bottom(), rate=2)")
+if PROTOCOL_STEPS.count(WASTE_DISPENSE[0]) != 1:
+    raise ValueError("PROTOCOL_STEPS does not have the waste dispense which the apiLevel 2.20 templates replace")
+STEPS_2_20 = PROTOCOL_STEPS.replace(*WASTE_DISPENSE)
+
+PROTOCOL_HEADER = dedent(""" 
+    
+    import random
+    from opentrons import protocol_api
+
+    metadata = {{
+        "apiLevel": "2.15",
+        "protocolName": "Serial Dilutions (PB exp {experiment_id})",
+        "description": "Serial dilution with parameters from PB experiment {experiment_id}",
+        "author": "Wilson et al"
+    }}
+
+    PARAMS = {params_literal}
+
+""")
+
+PROTOCOL_SETUP = dedent("""
+    def run(protocol: protocol_api.ProtocolContext):
+
+        plate = protocol.load_labware('costar3370flatbottomtransparent_96_wellplate_200ul', 3)
+        tiprack_1 = protocol.load_labware('opentrons_96_tiprack_300ul', 1)
+        p300 = protocol.load_instrument('p300_multi_gen2', 'left', tip_racks=[tiprack_1])
+        reservoir = protocol.load_labware('4ti0136_96_wellplate_2200ul', 2)
+
+        p300.flow_rate.aspirate = 80
+        p300.flow_rate.dispense = 40
+        p300.flow_rate.blow_out = 150
+
+        fluorescein_src = reservoir['A1']
+        pbs_src         = reservoir['A6']
+        waste           = reservoir['A12']
+""")
+
+PROTOCOL_TEMPLATE = PROTOCOL_HEADER + PROTOCOL_SETUP.lstrip("\n") + indent(PROTOCOL_STEPS, "    ")
+
+# Timing instrumentation (make_protocol_code with instrument=True). The pipette steps are wrapped so that the robot logs the phase, 
+# start and duration of each one to TIMING_DIR/timing_<experiment id>_<start time>.log. Steps are assigned to the phases used by 
+# CodeB_simulator, so measured and predicted times can be compared. Nothing is logged when the protocol is simulated.
+
+TIMING_CODE = dedent("""
+    TIMING_DIR = {timing_dir!r}
+
+    def instrument(p300, reservoir):
+        import os
+        import time
+
+        os.makedirs(TIMING_DIR, exist_ok=True)
+        path = os.path.join(TIMING_DIR, "timing_{experiment_id}_" + time.strftime("%Y%m%d-%H%M%S") + ".log")
+        lines = ["# {experiment_id} %.0f" % time.time()]
+        state = {{"phase": "Tips", "well": None}}
+        t0 = time.monotonic()
+
+        def well_of(location): # aspirate and dispense are given a Location (well.bottom()) or a Well.
+            return location.labware.as_well() if hasattr(location, "labware") else location
+
+        def phase_of(step, args):
+            well = well_of(args[1]) if len(args) > 1 else None
+            if step in ("pick_up_tip", "drop_tip"):
+                state["well"] = None
+                return "Tips"
+            if step == "aspirate":
+                if well is not None and well is state["well"]:
+                    state["phase"] = "Mix"
+                elif well is not None and well.parent is reservoir:
+                    state["phase"] = "Aliquot"
+                else:
+                    state["phase"] = "Dilution"
+            elif step == "dispense":
+                if state["phase"] != "Mix" and well is not None and well.parent is reservoir:
+                    state["phase"] = "Waste"
+                state["well"] = well
+            else:
+                state["well"] = None
+            return state["phase"]
+
+        def timed(step):
+            call = getattr(p300, step)
+            def wrapper(*args, **kwargs):
+                phase = phase_of(step, args)
+                start = time.monotonic()
+                result = call(*args, **kwargs)
+                lines.append("%s,%s,%.3f,%.3f" % (phase, step, start - t0, time.monotonic() - start))
+                if step == "drop_tip": # The log is written while the pipette has no tip, outside the timed steps.
+                    with open(path, "a") as log:
+                        log.write("\\n".join(lines) + "\\n")
+                    del lines[:]
+                return result
+            return wrapper
+
+        for step in ("pick_up_tip", "aspirate", "dispense", "blow_out", "touch_tip", "drop_tip"):
+            setattr(p300, step, timed(step))
+
+""")
+
+TIMING_START = """
+    if not protocol.is_simulating():
+        instrument(p300, reservoir)
+"""
+
+INSTRUMENTED_TEMPLATE = PROTOCOL_HEADER + TIMING_CODE.lstrip("\n") + PROTOCOL_SETUP.lstrip("\n") + TIMING_START + indent(PROTOCOL_STEPS, "    ")
+
+# Table-driven protocol (main_table). One fixed protocol runs any experiment of a design: the resolved parameter table is given as
+# a CSV runtime parameter when the run is set up in the Opentrons App, and the experiment id picks its row. CSV runtime parameters
+# need apiLevel 2.20.
+
+TABLE_TEMPLATE = dedent(""" 
+    
+    import random
+    from opentrons import protocol_api
+
+    metadata = {{
+        "protocolName": "Serial Dilutions (PB parameter table)",
+        "description": "Serial dilution with the parameters of one experiment of the parameter table, chosen when the run is set up",
+        "author": "Wilson et al"
+    }}
+
+    requirements = {{"robotType": "OT-2", "apiLevel": "2.20"}}
+
+    def add_parameters(parameters):
+        parameters.add_csv_file(
+            variable_name="param_table",
+            display_name="Parameter table",
+            description="{table_file} written by CodeA.main_table"
+        )
+        parameters.add_int(
+            variable_name="experiment_id",
+            display_name="Experiment id",
+            description="Row of the parameter table to run",
+            default=1,
+            minimum=1,
+            maximum={max_experiments}
+        )
+
+    def load_params(protocol): # The row of the parameter table for the chosen experiment id, as a PARAMS dictionary.
+        rows = protocol.params.param_table.parse_as_csv()
+        header = rows[0]
+        for row in rows[1:]:
+            if row and row[0] == str(protocol.params.experiment_id):
+                return {{k: int(v) if v.lstrip("-").isdigit() else float(v) for k, v in zip(header[1:], row[1:])}}
+        raise ValueError("Experiment %d is not in the parameter table" % protocol.params.experiment_id)
+
+""") + PROTOCOL_SETUP.lstrip("\n") + """
+    PARAMS = load_params(protocol)
+""" + indent(STEPS_2_20, "    ")
+
+
+# Multi-plate session template: runs several experiments in one deck session, one plate per experiment. Tips are taken 3 columns 
+# per experiment from SESSION_TIPRACK_SLOTS in order, and each experiment takes its PBS from the reservoir well in PBS_WELLS.
+
+SESSION_TEMPLATE = dedent(""" 
+    
+    import random
+    from opentrons import protocol_api
+
+    metadata = {{
+        "apiLevel": "2.15",
+        "protocolName": "Serial Dilutions (PB session {session_id})",
+        "description": "Serial dilutions with parameters from PB experiments {experiment_ids}, one plate per experiment",
+        "author": "Wilson et al"
+    }}
+
+    PARAMS_LIST = {params_literal}
+
+    PLATE_SLOTS   = {plate_slots}
+    TIPRACK_SLOTS = {tiprack_slots}
+    PBS_WELLS     = {pbs_wells}
+
+    def run(protocol: protocol_api.ProtocolContext):
+
+        tipracks = [protocol.load_labware('opentrons_96_tiprack_300ul', slot) for slot in TIPRACK_SLOTS]
+        plates   = [protocol.load_labware('costar3370flatbottomtransparent_96_wellplate_200ul', slot) for slot in PLATE_SLOTS]
+        p300 = protocol.load_instrument('p300_multi_gen2', 'left', tip_racks=tipracks)
+        reservoir = protocol.load_labware('4ti0136_96_wellplate_2200ul', 2)
+
+        p300.flow_rate.aspirate = 80
+        p300.flow_rate.dispense = 40
+        p300.flow_rate.blow_out = 150
+
+        fluorescein_src = reservoir['A1']
+        waste           = reservoir['A12']
+
+        for i, PARAMS in enumerate(PARAMS_LIST):
+            plate     = plates[i]
+            tiprack_1 = tipracks[i // 4]
+            pbs_src   = reservoir[PBS_WELLS[i]]
+""") + indent(PROTOCOL_STEPS, "        ")
+
+# Row-multiplexed template (main_multiplex): up to 8 experiments on one plate, one per plate row. The multi-channel pipette picks up
+# a single tip on its front nozzle (partial tip pickup, apiLevel 2.20), and each row runs the steps of PROTOCOL_STEPS with its own
+# PARAMS, its own tips from the plate's 3 tip columns and its own reservoir wells (row X takes fluorescein from X1, PBS from X6 and
+# puts waste in X12, as channel X of the multi-channel does). Rows run from A to H, so the tips behind the front nozzle have already
+# been used. The unused nozzles reach into the slots behind the labware (4, 5 and 6), which must be empty.
+
+ROW_WELLS = [("plate['A1']", "plate[ROW + '1']"), ("plate['A11']", "plate[ROW + '11']"),
+             ("plate[f'A{{", "plate[f'{{ROW}}{{"), ('f"A{{start_col', 'f"{{ROW}}{{start_col')]
+ROW_STEPS = STEPS_2_20
+for old, new in ROW_WELLS:
+    ROW_STEPS = ROW_STEPS.replace(old, new)
+if re.search(r"""(plate\[|f)['"]A[\d{]""", ROW_STEPS): # Stops edits to PROTOCOL_STEPS from leaving a row A well in the row-multiplexed protocols.
+    raise ValueError("PROTOCOL_STEPS uses a well of row A which ROW_WELLS does not replace")
+
+MULTIPLEX_TEMPLATE = dedent(""" 
+    
+    import random
+    from opentrons import protocol_api
+    from opentrons.protocol_api import SINGLE
+
+    metadata = {{
+        "protocolName": "Serial Dilutions (PB plate {plate_id})",
+        "description": "Serial dilutions with parameters from PB experiments {experiment_ids}, one plate row per experiment",
+        "author": "Wilson et al"
+    }}
+
+    requirements = {{"robotType": "OT-2", "apiLevel": "2.20"}}
+
+    PARAMS_LIST = {params_literal}
+
+    def run(protocol: protocol_api.ProtocolContext):
+
+        plate = protocol.load_labware('costar3370flatbottomtransparent_96_wellplate_200ul', 3)
+        tiprack_1 = protocol.load_labware('opentrons_96_tiprack_300ul', 1)
+        p300 = protocol.load_instrument('p300_multi_gen2', 'left', tip_racks=[tiprack_1])
+        reservoir = protocol.load_labware('4ti0136_96_wellplate_2200ul', 2)
+        p300.configure_nozzle_layout(style=SINGLE, start="H1", tip_racks=[tiprack_1])
+
+        p300.flow_rate.aspirate = 80
+        p300.flow_rate.dispense = 40
+        p300.flow_rate.blow_out = 150
+
+        for ROW, PARAMS in zip("{rows}", PARAMS_LIST):
+            fluorescein_src = reservoir[ROW + '1']
+            pbs_src         = reservoir[ROW + '6']
+            waste           = reservoir[ROW + '12']
+""") + indent(ROW_STEPS, "        ")
+
+def make_protocol_code(params: dict, experiment_id: str, instrument: bool | None = None): # Defines the protocol-maker function
+    
+    instrument = INSTRUMENT if instrument is None else instrument # Read when called, so setting CodeA.INSTRUMENT at run time takes effect.
+    params_literal = repr(params) # Converts params dictionary to a string called params_literal
+
+    if instrument: # The protocol also logs the time of each pipette step on the robot.
+        return INSTRUMENTED_TEMPLATE.format(experiment_id=experiment_id, params_literal=params_literal, timing_dir=TIMING_DIR)
+    return PROTOCOL_TEMPLATE.format(experiment_id=experiment_id, params_literal=params_literal) # Returns the template code with the correct params dictionary.
+
+def make_table_code(): # The fixed protocol of main_table. It does not depend on the design.
+    return TABLE_TEMPLATE.format(table_file=TABLE_FILE, max_experiments=TABLE_MAX_EXPERIMENTS)
+
+def make_session_code(experiments: list, session_id: str): # Makes one protocol which runs each (experiment_id, params) in experiments on its own plate.
+    n = len(experiments)
+    if n > min(len(SESSION_PLATE_SLOTS), 4 * len(SESSION_TIPRACK_SLOTS)):
+        raise ValueError(f"{n} experiments do not fit on the deck in one session")
+
+    # Tip columns are assigned by position in the session, so each session starts with full tip racks.
+    params_list = [dict(params, start_col=1 + 3 * (i % 4)) for i, (experiment_id, params) in enumerate(experiments)]
+    return SESSION_TEMPLATE.format(
+        session_id=session_id,
+        experiment_ids=", ".join(experiment_id for experiment_id, params in experiments),
+        params_literal=repr(params_list),
+        plate_slots=SESSION_PLATE_SLOTS[:n],
+        tiprack_slots=SESSION_TIPRACK_SLOTS[:(n + 3) // 4],
+        pbs_wells=session_pbs_wells(params_list),
+    )
+
+def make_multiplex_code(experiments: list, plate_id: str, start_col: int = 1): # Makes one protocol which runs each (experiment_id, params) in experiments on its own row of one plate.
+    if len(experiments) > len(PLATE_ROWS):
+        raise ValueError(f"{len(experiments)} experiments do not fit on the {len(PLATE_ROWS)} rows of a plate")
+
+    # Every row of the plate takes its tips from the same 3 tip columns, one tip per row, so a plate uses a tip block as in main.
+    params_list = [dict(params, start_col=start_col) for experiment_id, params in experiments]
+    return MULTIPLEX_TEMPLATE.format(
+        plate_id=plate_id,
+        experiment_ids=", ".join(experiment_id for experiment_id, params in experiments),
+        params_literal=repr(params_list),
+        rows=PLATE_ROWS,
+    )
+
+def pbs_needed(params: dict): # uL of PBS one experiment takes from its reservoir well, including the disposal volume in multi-dispense mode.
+    return PBS_PER_PLATE + (params["Aliquot_Disposal_Volume"] if params["Aliquot_Dispenses_Per_Aspirate"] > 1 else 0)
+
+def session_pbs_wells(params_list: list): # Assigns each experiment of a session to a PBS well, moving to the next column when a well runs low.
+    columns = iter(SESSION_PBS_COLUMNS)
+    wells = []
+    left = 0
+    for params in params_list:
+        need = pbs_needed(params)
+        if need > left:
+            col = next(columns, None)
+            if col is None:
+                raise ValueError("Not enough reservoir columns for the PBS of this session")
+            left = RESERVOIR_WELL_VOLUME - RESERVOIR_DEAD_VOLUME
+        left -= need
+        wells.append(f"A{col}")
+    return wells
+
+TEMPLATE_VERSION = hashlib.sha256(PROTOCOL_TEMPLATE.encode()).hexdigest()[:12] # Changes whenever the template is edited, so cached protocols are rebuilt.
+INSTRUMENTED_VERSION = hashlib.sha256(INSTRUMENTED_TEMPLATE.encode()).hexdigest()[:12]
+
+def template_version(instrument: bool | None = None): # Version of the template make_protocol_code uses, read from INSTRUMENT when instrument is None.
+    instrument = INSTRUMENT if instrument is None else instrument
+    return INSTRUMENTED_VERSION if instrument else TEMPLATE_VERSION
+
+def params_hash(params: dict, instrument: bool | None = None): # Hash of the resolved parameters and the template version. Rows with the same hash produce the same protocol.
+    key = json.dumps({"template": template_version(instrument), "params": params}, sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+# Inheritance rules: a step-specific parameter with no default (None) inherits from the parameter named without its step prefix,
+# e.g. Aliquot_Aspiration_Rate -> Aspiration_Rate and Final_Mix_Dispense_Rate -> Mix_Dispense_Rate. Min and Max mix heights inherit 
+# from the constant mix height, e.g. Mix_Aspiration_Height_Min -> Mix_Aspiration_Height. New parameters named this way need no extra code.
+
+def _parent(k: str):
+    if k.endswith("_Min") or k.endswith("_Max"):
+        return k[:-4]
+    return k.split("_", 1)[1]
+
+INHERITANCE = {k: _parent(k) for k, v in Default_Params.items() if v is None} # Maps each parameter to the parameter it inherits from.
+
+def _root(k: str): # The global parameter at the top of the inheritance chain of k.
+    while k in INHERITANCE:
+        k = INHERITANCE[k]
+    return k
+
+def _depth(k: str):
+    return 0 if k not in INHERITANCE else 1 + _depth(INHERITANCE[k])
+
+RESOLUTION_ORDER = sorted(Default_Params, key=_depth)                                  # Parents are always resolved before their children.
+PARAM_TYPES = {k: type(Default_Params[_root(k)]) for k in Default_Params}              # Step-specific parameters take the type of their global parameter.
+RANGE_PAIRS = [(k, k[:-4] + "_Max") for k in Default_Params if k.endswith("_Min")]     # Min/Max parameters which define a range of heights.
+
+def resolve_design(design: pd.DataFrame):
+    # Resolves the whole JMP table in one pass, one column at a time. Returns a table of parameters with one row per experiment 
+    # (index is the experiment id) and a report of unknown columns, values which are not numbers, ranges where Min > Max and
+    # rows which fail the preflight checks.
+    n = len(design)
+    report = {"unknown_columns": [c for c in design.columns if c not in Default_Params], "bad_values": [], "bad_ranges": []}
+    columns = {}
+
+    for k in RESOLUTION_ORDER:
+        values = np.full(n, np.nan) # NaN marks a value which is not given in the table.
+        if k in design.columns:
+            raw = design[k].astype(str).str.strip()
+            given = (raw != "").to_numpy()
+            values = pd.to_numeric(raw.where(given), errors="coerce").to_numpy(dtype=float, copy=True)
+            bad = given & ~np.isfinite(values)
+            if PARAM_TYPES[k] is int:
+                bad |= np.isfinite(values) & (values != np.round(values)) # Whole-number parameters such as Mixing_Repetitions.
+            for i in np.flatnonzero(bad):
+                report["bad_values"].append((i + 1, k, raw.iat[i]))
+            values[bad] = np.nan
+
+        fallback = columns[INHERITANCE[k]] if k in INHERITANCE else Default_Params[k] # Unassigned parameters take their parent or default value.
+        columns[k] = np.where(np.isnan(values), fallback, values)
+
+    for lo, hi in RANGE_PAIRS:
+        for i in np.flatnonzero(columns[lo] > columns[hi]):
+            report["bad_ranges"].append((i + 1, lo, hi, columns[lo][i], columns[hi][i]))
+
+    table = pd.DataFrame({k: columns[k].astype(PARAM_TYPES[k]) for k in Default_Params}, index=pd.RangeIndex(1, n + 1, name="experiment_id"))
+    table["start_col"] = 1 + 3 * ((table.index.to_numpy() - 1) % 4) # the index of the row assigns the start column to start taking tips from.
+    report["preflight"] = preflight(table)
+    return table, report
+
+# Volumes set in the protocol template (fluorescein_volume, pbs_volume and dilution_volume), read from the template text so the
+# checks below follow any edits to it.
+TEMPLATE_VOLUMES = {k: float(v) for k, v in re.findall(r"^(\w+_volume)\s*=\s*([\d.]+)\s*$", PROTOCOL_STEPS, re.M)}
+
+def preflight(table: pd.DataFrame):
+    # Checks a resolved table against the labware on the deck before any protocols are written, without the Opentrons package.
+    # Every check is made for all rows at once. Returns a list of (experiment id, problem).
+    v = TEMPLATE_VOLUMES
+    ids = table.index.to_numpy()
+    problems = []
+    def check(bad, message):
+        for i in np.flatnonzero(bad):
+            problems.append((int(ids[i]), message(i)))
+
+    # Template constants, which apply to every row.
+    if v["fluorescein_volume"] > min(PLATE_WELL_VOLUME, TIP_VOLUME):
+        problems.append((None, f"fluorescein_volume ({v['fluorescein_volume']} uL) does not fit in a plate well or tip"))
+    if v["pbs_volume"] + v["dilution_volume"] > PLATE_WELL_VOLUME:
+        problems.append((None, f"pbs_volume + dilution_volume ({v['pbs_volume'] + v['dilution_volume']} uL) overfills a {PLATE_WELL_VOLUME} uL plate well"))
+
+    fraction = table["Mixing_Fraction"].to_numpy()
+    mix_volume = (v["dilution_volume"] + v["pbs_volume"]) * fraction
+    check((fraction <= 0) | (fraction > 1), lambda i: f"Mixing_Fraction {fraction[i]} must be above 0 and at most 1")
+    check(mix_volume > TIP_VOLUME, lambda i: f"mix volume {mix_volume[i]:.0f} uL exceeds the {TIP_VOLUME} uL tip")
+    check(table["Mixing_Repetitions"].to_numpy() < 0, lambda i: "Mixing_Repetitions is negative")
+
+    per_asp = table["Aliquot_Dispenses_Per_Aspirate"].to_numpy()
+    disposal = table["Aliquot_Disposal_Volume"].to_numpy()
+    aliquot = v["pbs_volume"] * per_asp + np.where(per_asp > 1, disposal, 0)
+    check((per_asp < 1) | (per_asp > 11), lambda i: f"Aliquot_Dispenses_Per_Aspirate {per_asp[i]} must be between 1 and 11")
+    check(aliquot > TIP_VOLUME, lambda i: f"multi-dispense aspirates {aliquot[i]:.0f} uL, more than the {TIP_VOLUME} uL tip")
+    check(disposal < 0, lambda i: "Aliquot_Disposal_Volume is negative")
+    pbs = PBS_PER_PLATE + np.where(per_asp > 1, disposal, 0)
+    check(pbs > RESERVOIR_WELL_VOLUME - RESERVOIR_DEAD_VOLUME, lambda i: f"needs {pbs[i]:.0f} uL of PBS from one {RESERVOIR_WELL_VOLUME} uL reservoir well")
+
+    for k in [k for k in Default_Params if "Height" in k]:
+        heights = table[k].to_numpy()
+        inherited = table[INHERITANCE[k]].to_numpy() == heights if k in INHERITANCE else False # Only reported where the value is set.
+        check((heights < 0) & ~inherited, lambda i: f"{k} {heights[i]} is below the bottom of the well")
+    for k in [k for k in Default_Params if k.endswith("_Rate")]:
+        rates = table[k].to_numpy()
+        check(rates <= 0, lambda i: f"{k} {rates[i]} must be above 0")
+    radius = table["Touch_Tip_Radius"].to_numpy()
+    check((radius <= 0) | (radius > 1), lambda i: f"Touch_Tip_Radius {radius[i]} must be above 0 and at most 1")
+    speed = table["Touch_Tip_Speed"].to_numpy()
+    lo, hi = TOUCH_TIP_SPEED_RANGE
+    check((speed < lo) | (speed > hi), lambda i: f"Touch_Tip_Speed {speed[i]} must be between {lo} and {hi} mm/s")
+
+    # Tips: each experiment uses 3 tip columns from start_col, and the 4 experiments which share a rack must not reuse a column.
+    start = table["start_col"].to_numpy()
+    check((start < 1) | (start + 2 > TIPRACK_COLUMNS), lambda i: f"start_col {start[i]} needs tip columns past {TIPRACK_COLUMNS}")
+    rack = (ids - 1) // 4
+    order = np.lexsort((start, rack))
+    overlap = np.zeros(len(ids), dtype=bool)
+    overlap[order[1:]] = (rack[order[1:]] == rack[order[:-1]]) & (start[order[1:]] < start[order[:-1]] + 3)
+    check(overlap, lambda i: f"start_col {start[i]} reuses tips of another experiment on the same tip rack")
+    return problems
+
+def print_report(report: dict):
+    for c in report["unknown_columns"]:
+        print(f"Ignored column '{c}': not a parameter in Default_Params")
+    for row, k, value in report["bad_values"]:
+        print(f"Row {row}: '{value}' is not a valid value for {k}")
+    for row, lo, hi, a, b in report["bad_ranges"]:
+        print(f"Row {row}: {lo} ({a}) is greater than {hi} ({b})")
+    for row, problem in report.get("preflight", []):
+        print(f"Row {row}: {problem}" if row is not None else f"Template: {problem}")
+
+def load_design(design_csv: str = DESIGN_CSV): # Loads and resolves a JMP table. Stops before any protocols are written if a row is invalid.
+    if isinstance(design_csv, pd.DataFrame): # A design made in memory, e.g. by CodeA_doe, can be used in place of a CSV file by every main function.
+        design, name = design_csv.fillna(""), "the design"
+    else:
+        design, name = pd.read_csv(design_csv, dtype=str, keep_default_na=False), design_csv
+    table, report = resolve_design(design)
+    print_report(report)
+    problems = len(report["bad_values"]) + len(report["bad_ranges"]) + len(report["preflight"])
+    if problems:
+        raise ValueError(f"{problems} problems found in {name}")
+    return table
+
+def iter_params(table: pd.DataFrame): # Yields (experiment_id, params dictionary) for each row of a resolved table.
+    columns = [table[c].tolist() for c in table.columns] # tolist gives plain Python ints and floats for the PARAMS literal.
+    for experiment_id, values in zip(table.index.tolist(), zip(*columns)):
+        yield str(experiment_id), dict(zip(table.columns, values))
+
+def protocol_filename(experiment_id: str):
+    return f"serial_dilution_BB_exp_{experiment_id}.py"
 
 def main(): #This is the main code-writer function.
-    with open(DESIGN_CSV, newline='') as f: # This code opens the JMP table and reads each row as a new dictionary.
-        reader = csv.DictReader(f) 
-
-        for idx, row in enumerate(reader, start=1): # This for loop iterates through each row of the table.
-            experiment_id = str(idx) # The experiment name is defined by the index of the row.
-            block_index = (idx - 1) % 4 
-            start_col = 1 + 3 * block_index # the index of the row assigns the start column to start taking tips from.
-            
-        
-            params = Default_Params.copy() # Creates a parameters dictionary as a copy of the default parameters.
-
-            for k in params: # Iterates through parameter names
-                if k in reader.fieldnames: # If a parameter is in the table
-                    value = row[k].strip()
-                    if value == "": # As long as the parameter has a value
-                        continue
-                    elif isinstance(Default_Params[k], int): # Converts default value to the JMP value and store value in parameters dictionary.
-                        params[k] = int(value)
-                    elif isinstance(Default_Params[k], float):
-                        params[k] = float(value)
-                    else:
-                        params[k] = str(value)
-
-            params["start_col"] = start_col #Add the tip start column to the end of the parameters dictionary.
-            
-            #Inheritance rules: set unassigned step-specific parameters to global defualts.
-            # Aspiration rates
-            
-            if params["Aliquot_Aspiration_Rate"] is None:
-                params["Aliquot_Aspiration_Rate"] = params["Aspiration_Rate"]
-
-            if params["Dilution_Aspiration_Rate"] is None:
-                params["Dilution_Aspiration_Rate"] = params["Aspiration_Rate"]
-
-            if params["Mix_Aspiration_Rate"] is None:
-                params["Mix_Aspiration_Rate"] = params["Aspiration_Rate"]
-
-
-        
-            # Aspiration heights
-            
-            if params["Aliquot_Aspiration_Height"] is None:
-                params["Aliquot_Aspiration_Height"] = params["Aspiration_Height"]
-
-            if params["Dilution_Aspiration_Height"] is None:
-                params["Dilution_Aspiration_Height"] = params["Aspiration_Height"]
-
-            if params["Mix_Aspiration_Height"] is None:
-                params["Mix_Aspiration_Height"] = params["Aspiration_Height"]
-
-            if params["Mix_Aspiration_Height_Min"] is None:
-                params["Mix_Aspiration_Height_Min"] = params["Mix_Aspiration_Height"] # Assign min and max heights to standard mix height if range is not specified
-
-            if params["Mix_Aspiration_Height_Max"] is None:
-                params["Mix_Aspiration_Height_Max"] = params["Mix_Aspiration_Height"]
-
-            # Dispense rates
-            
-            if params["Aliquot_Dispense_Rate"] is None:
-                params["Aliquot_Dispense_Rate"] = params["Dispense_Rate"]
-
-            if params["Dilution_Dispense_Rate"] is None:
-                params["Dilution_Dispense_Rate"] = params["Dispense_Rate"]
-
-            if params["Mix_Dispense_Rate"] is None:
-                params["Mix_Dispense_Rate"] = params["Dispense_Rate"]
-
-            if params["Final_Mix_Dispense_Rate"] is None:
-                params["Final_Mix_Dispense_Rate"] = params["Mix_Dispense_Rate"] # Final mix dispense rate is the same as the standard mix dispense rate if unspecified.
-
-            # Dispense heights
-
-            if params["Aliquot_Dispense_Height"] is None:
-                params["Aliquot_Dispense_Height"] = params["Dispense_Height"]
-
-            if params["Dilution_Dispense_Height"] is None:
-                params["Dilution_Dispense_Height"] = params["Dispense_Height"]
-
-            if params["Mix_Dispense_Height"] is None:
-                params["Mix_Dispense_Height"] = params["Dispense_Height"]
-
-            if params["Mix_Dispense_Height_Min"] is None:
-                params["Mix_Dispense_Height_Min"] = params["Mix_Dispense_Height"] # Assign min and max heights to standard mix height if range is not specified
-
-            if params["Mix_Dispense_Height_Max"] is None:
-                params["Mix_Dispense_Height_Max"] = params["Mix_Dispense_Height"]
-        
-            code = make_protocol_code(params, experiment_id)                      # Protocol code is made using params from a specific JMP row and the corresponding experiment id.
-            filename = f"serial_dilution_BB_exp_{experiment_id}.py"
-            with open(filename, "w") as out:
-                out.write(code)                                                   # The protocol code for the row is written as a separate .py file with the experiment ID in the name.
-            print(f"Wrote {filename}")
+    table = load_design(DESIGN_CSV) # This code loads the JMP table and resolves the parameters of every row.
+
+    for experiment_id, params in iter_params(table): # This for loop iterates through each row of the table.
+        code = make_protocol_code(params, experiment_id)                      # Protocol code is made using params from a specific JMP row and the corresponding experiment id.
+        filename = protocol_filename(experiment_id)
+        with open(filename, "w") as out:
+            out.write(code)                                                   # The protocol code for the row is written as a separate .py file with the experiment ID in the name.
+        print(f"Wrote {filename}")
+
+def _write_protocol(job): # Worker for main_parallel: makes and writes the protocol for one row in a separate process.
+    experiment_id, params, out_dir = job
+    filename = os.path.join(out_dir, protocol_filename(experiment_id))
+    with open(filename, "w") as out:
+        out.write(make_protocol_code(params, experiment_id))
+    return filename
+
+def main_parallel(design_csv: str = DESIGN_CSV, out_dir: str = ".", workers: int = PARALLEL_WORKERS, batch_size: int = BATCH_SIZE):
+    # Generation mode for large designs. The resolved table is compact, and protocols are made in batches of batch_size, 
+    # so only one batch of protocol code is held in memory. Each batch is made and written across a pool of processes.
+    workers = workers or os.cpu_count() or 1
+    os.makedirs(out_dir, exist_ok=True)
+    written = 0
+    t0 = time.perf_counter()
+    table = load_design(design_csv)
+    jobs = ((experiment_id, params, out_dir) for experiment_id, params in iter_params(table))
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        while True:
+            batch = list(islice(jobs, batch_size))
+            if not batch:
+                break
+            chunksize = max(1, len(batch) // (4 * workers)) # Several chunks per worker keeps the pool balanced without sending one row at a time.
+            for _ in pool.map(_write_protocol, batch, chunksize=chunksize):
+                written += 1
+            elapsed = time.perf_counter() - t0
+            print(f"Wrote {written} protocols ({written / elapsed:.0f} rows/sec)")
+
+    elapsed = time.perf_counter() - t0
+    print(f"Finished: {written} protocols in {elapsed:.2f} s ({written / elapsed if elapsed else 0:.0f} rows/sec) using {workers} workers")
+    return written
+
+def main_cached(design_csv: str = DESIGN_CSV, out_dir: str = "."):
+    # Generation mode that only writes protocols for new or changed rows. Each protocol is named by the hash of its 
+    # resolved parameters, so identical parameter sets (e.g. centre-point replicates in the same tip block) share one file.
+    # The manifest records which file each experiment id should run.
+    t0 = time.perf_counter()
+    os.makedirs(out_dir, exist_ok=True)
+    manifest_path = os.path.join(out_dir, MANIFEST_FILE)
+    instrument = INSTRUMENT # Read once, so the hashes, protocols and manifest all use the same template.
+
+    old_experiments = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            old_experiments = json.load(f)["experiments"]
+
+    experiments = {}
+    written = 0
+    for experiment_id, params in iter_params(load_design(design_csv)):
+        h = params_hash(params, instrument)
+        filename = f"serial_dilution_BB_{h[:12]}.py"
+        experiments[experiment_id] = {"hash": h, "file": filename}
+
+        path = os.path.join(out_dir, filename)
+        if not os.path.exists(path): # Only new or changed parameter sets need a new protocol.
+            with open(path, "w") as out:
+                out.write(make_protocol_code(params, h[:12], instrument))
+            written += 1
+
+    # Remove protocols which are no longer used by any experiment in the design.
+    in_use = {e["file"] for e in experiments.values()}
+    for filename in {e["file"] for e in old_experiments.values()} - in_use:
+        path = os.path.join(out_dir, filename)
+        if os.path.exists(path):
+            os.remove(path)
+
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"template_version": template_version(instrument), "experiments": experiments}, f, indent=1)
+    os.replace(tmp_path, manifest_path) # Replaces the manifest in one step so an interrupted run cannot leave it half-written.
+
+    elapsed = time.perf_counter() - t0
+    print(f"{len(experiments)} experiments, {len(in_use)} unique protocols: wrote {written}, reused {len(in_use) - written} ({elapsed * 1000:.0f} ms)")
+    return experiments
+
+def main_table(design_csv: str = DESIGN_CSV, out_dir: str = "."):
+    # Generation mode which writes one fixed protocol and the resolved parameter table, instead of one protocol per row.
+    # The protocol only needs uploading to the robot once. For each run, choose the table and the experiment id in the Opentrons App.
+    t0 = time.perf_counter()
+    os.makedirs(out_dir, exist_ok=True)
+    table = load_design(design_csv)
+    if table.index.max() > TABLE_MAX_EXPERIMENTS:
+        raise ValueError(f"The design has more than {TABLE_MAX_EXPERIMENTS} experiments")
+
+    protocol_path = os.path.join(out_dir, TABLE_PROTOCOL)
+    code = make_table_code()
+    old = None
+    if os.path.exists(protocol_path):
+        with open(protocol_path) as f:
+            old = f.read()
+    if code != old: # The protocol is only rewritten when the template changes, so it does not need uploading again.
+        with open(protocol_path, "w") as out:
+            out.write(code)
+    table.to_csv(os.path.join(out_dir, TABLE_FILE))
+
+    elapsed = time.perf_counter() - t0
+    print(f"Wrote {TABLE_FILE} ({len(table)} experiments) and {TABLE_PROTOCOL} ({elapsed * 1000:.0f} ms)")
+    return table
+
+def main_sessions(design_csv: str = DESIGN_CSV, out_dir: str = ".", per_session: int = EXPERIMENTS_PER_SESSION):
+    # Generation mode which packs per_session experiments into each protocol, so a whole block of the design runs without 
+    # reloading tips or plates. Writes serial_dilution_BB_session_<n>.py and prints the deck layout for each session.
+    os.makedirs(out_dir, exist_ok=True)
+    experiments = list(iter_params(load_design(design_csv)))
+    sessions = {}
+
+    for n, first in enumerate(range(0, len(experiments), per_session), start=1):
+        block = experiments[first:first + per_session]
+        filename = f"serial_dilution_BB_session_{n}.py"
+        with open(os.path.join(out_dir, filename), "w") as out:
+            out.write(make_session_code(block, str(n)))
+        sessions[filename] = [experiment_id for experiment_id, params in block]
+
+        plates = ", ".join(f"exp {experiment_id} -> slot {slot}" for (experiment_id, params), slot in zip(block, SESSION_PLATE_SLOTS))
+        racks = SESSION_TIPRACK_SLOTS[:(len(block) + 3) // 4]
+        pbs_cols = sorted({int(well[1:]) for well in session_pbs_wells([params for experiment_id, params in block])})
+        print(f"Wrote {filename}: tip racks in slots {racks}, PBS in reservoir columns {pbs_cols}, plates: {plates}")
+
+    return sessions
+
+def main_multiplex(design_csv: str = DESIGN_CSV, out_dir: str = ".", per_plate: int = len(PLATE_ROWS)):
+    # Generation mode which runs up to per_plate experiments on each plate, one per plate row, so a plate and a plate reader read
+    # test up to 8 parameter sets instead of one. Rows are filled in design order, and plates take the tip blocks in turn (start
+    # columns 1, 4, 7 and 10). Writes serial_dilution_BB_plate_<n>.py for each plate and PLATE_MAP_FILE, which Code C needs to
+    # analyse each row as its own experiment (see CodeC_incremental.update). Each plate takes about 8 times as long to pipette.
+    os.makedirs(out_dir, exist_ok=True)
+    experiments = list(iter_params(load_design(design_csv)))
+    plate_map = []
+    plates = {}
+
+    for n, first in enumerate(range(0, len(experiments), per_plate), start=1):
+        block = experiments[first:first + per_plate]
+        start_col = 1 + 3 * ((n - 1) % 4)
+        filename = MULTIPLEX_FILE.format(plate_id=n)
+        with open(os.path.join(out_dir, filename), "w") as out:
+            out.write(make_multiplex_code(block, str(n), start_col))
+        plates[filename] = [experiment_id for experiment_id, params in block]
+        plate_map += [(int(experiment_id), n, row) for (experiment_id, params), row in zip(block, PLATE_ROWS)]
+        print(f"Wrote {filename}: tip columns {start_col}-{start_col + 2}, rows: " + ", ".join(f"{row} exp {experiment_id}" for (experiment_id, params), row in zip(block, PLATE_ROWS)))
+
+    pd.DataFrame(plate_map, columns=["Experiment Number", "Plate", "Row"]).to_csv(os.path.join(out_dir, PLATE_MAP_FILE), index=False)
+    print(f"Wrote {PLATE_MAP_FILE} ({len(plate_map)} experiments on {len(plates)} plates)")
+    return plates
@@ -0,0 +1,206 @@
+# Design of experiments for Code A, in place of designs exported from JMP.
+# Makes full factorial, fractional factorial, Plackett-Burman and Latin hypercube designs on the Default_Params keys, and orders
+# the runs in blocks of 4 so that each tip rack (start_col 1, 4, 7, 10) holds a balanced block of the design. The design is a
+# DataFrame which every Code A mode accepts in place of a CSV file, so protocols can be made without writing the design first.
+#
+#   design = generate("plackett_burman", {"Aspiration_Rate": (0.5, 2.0), "Mixing_Repetitions": (1, 5), ...})
+#   CodeA.main_table(design)                # or main_parallel(design, out_dir), main_cached(design, out_dir), ...
+#   design.to_csv("pb_design.csv", index=False)
+
+from itertools import combinations, product
+
+import numpy as np
+import pandas as pd
+
+import CodeA
+
+BLOCK_SIZE = 4              # Experiments per tip rack: each takes 3 of the 12 tip columns.
+BLOCK_SEARCH_MAX = 256      # Designs with more runs than this are blocked by randomising the run order instead of by search.
+
+# First rows of the cyclic Plackett-Burman designs (Plackett and Burman, 1946). Sizes which are powers of 2 are made from
+# Hadamard matrices instead.
+PB_GENERATORS = {
+    12: "++-+++---+-",
+    20: "++--++++-+-+----++-",
+    24: "+++++-+-++--++--+-+----",
+}
+
+# Generators of the minimum aberration 2-level fractional factorials (Montgomery, Design and Analysis of Experiments, Table
+# 8.14), by (runs, factors). Letters are the base factors, the first log2(runs) factors, which form a full factorial; each word
+# gives one further factor as the product of those columns.
+FF_GENERATORS = {
+    (8, 4): ["ABC"],                                                                                     # Resolution IV
+    (8, 5): ["AB", "AC"],                                                                                # III
+    (8, 6): ["AB", "AC", "BC"],                                                                          # III
+    (8, 7): ["AB", "AC", "BC", "ABC"],                                                                   # III
+    (16, 5): ["ABCD"],                                                                                   # V
+    (16, 6): ["ABC", "BCD"],                                                                             # IV
+    (16, 7): ["ABC", "BCD", "ACD"],                                                                      # IV
+    (16, 8): ["BCD", "ACD", "ABC", "ABD"],                                                               # IV
+    (16, 9): ["ABC", "BCD", "ACD", "ABD", "ABCD"],                                                       # III
+    (16, 10): ["ABC", "BCD", "ACD", "ABD", "ABCD", "AB"],                                                # III
+    (16, 11): ["ABC", "BCD", "ACD", "ABD", "ABCD", "AB", "AC"],                                          # III
+    (16, 12): ["ABC", "BCD", "ACD", "ABD", "ABCD", "AB", "AC", "AD"],                                    # III
+    (16, 13): ["ABC", "BCD", "ACD", "ABD", "ABCD", "AB", "AC", "AD", "BC"],                              # III
+    (16, 14): ["ABC", "BCD", "ACD", "ABD", "ABCD", "AB", "AC", "AD", "BC", "BD"],                        # III
+    (16, 15): ["ABC", "BCD", "ACD", "ABD", "ABCD", "AB", "AC", "AD", "BC", "BD", "CD"],                  # III
+    (32, 6): ["ABCDE"],                                                                                  # VI
+    (32, 7): ["ABCD", "ABDE"],                                                                           # IV
+    (32, 8): ["ABC", "ABD", "BCDE"],                                                                     # IV
+    (32, 9): ["ABCD", "ABCE", "ABDE", "ACDE"],                                                           # IV
+    (32, 10): ["ABCD", "ABCE", "ABDE", "ACDE", "BCDE"],                                                  # IV
+    (32, 11): ["ABC", "BCD", "CDE", "ACD", "ADE", "BDE"],                                                # IV
+    (64, 7): ["ABCDEF"],                                                                                 # VII
+    (64, 8): ["ABCD", "ABEF"],                                                                           # V
+    (64, 9): ["ABCD", "ACEF", "CDEF"],                                                                   # IV
+    (64, 10): ["BCDF", "ACDF", "ABDE", "ABCE"],                                                          # IV
+    (128, 8): ["ABCDEFG"],                                                                               # VIII
+    (128, 9): ["ACDFG", "BCEFG"],                                                                        # VI
+    (128, 10): ["ABCG", "BCDE", "ACDF"],                                                                 # V
+}
+
+
+def _check(factors: dict):
+    unknown = [k for k in factors if k not in CodeA.Default_Params]
+    if unknown:
+        raise ValueError(f"Not parameters in Default_Params: {', '.join(unknown)}")
+    for k, (lo, hi) in factors.items():
+        if not lo < hi:
+            raise ValueError(f"{k}: the low level ({lo}) must be below the high level ({hi})")
+
+
+def _uncode(coded: np.ndarray, factors: dict):
+    # Turns coded levels (-1 .. +1) into parameter values. Whole-number parameters are rounded.
+    lo, hi = np.array(list(factors.values()), dtype=float).T
+    values = lo + (coded + 1) / 2 * (hi - lo)
+    design = pd.DataFrame(values, columns=list(factors))
+    for k in factors:
+        design[k] = design[k].round().astype(int) if CodeA.PARAM_TYPES[k] is int else design[k].round(4)
+    return design
+
+
+def full_factorial(factors: dict, levels: int = 2):
+    # Every combination of `levels` equally spaced levels of each factor. Returns coded levels.
+    return np.array(list(product(np.linspace(-1, 1, levels), repeat=len(factors))))
+
+
+def fractional_factorial(factors: dict, runs: int):
+    # 2-level fractional factorial with `runs` (a power of 2) runs. The first log2(runs) factors form a full factorial, and the
+    # further factors are set by the minimum aberration generators in FF_GENERATORS, which give the highest resolution there is
+    # for the runs (e.g. resolution IV for 6 to 8 factors in 16 runs, with E = ABC and F = BCD for 6). Returns coded levels.
+    m = int(np.log2(runs))
+    if 2 ** m != runs or runs < len(factors) + 1:
+        raise ValueError(f"{runs} runs is not a power of 2 of at least {len(factors) + 1} for {len(factors)} factors")
+    if len(factors) < m:
+        raise ValueError(f"{runs} runs is more than the full factorial of {len(factors)} factors; use full_factorial or {2 ** len(factors)} runs")
+    if len(factors) == m:
+        return full_factorial(factors)
+    if (runs, len(factors)) not in FF_GENERATORS:
+        raise ValueError(f"No fractional factorial generators for {len(factors)} factors in {runs} runs; use plackett_burman")
+    base = full_factorial(dict(list(factors.items())[:m]))
+    extra = [np.prod(base[:, ["ABCDEFG".index(c) for c in word]], axis=1) for word in FF_GENERATORS[runs, len(factors)]]
+    return np.column_stack([base] + extra)
+
+
+def _hadamard(n: int):
+    h = np.ones((1, 1))
+    while len(h) < n:
+        h = np.block([[h, h], [h, -h]])
+    return h
+
+
+def plackett_burman(factors: dict):
+    # 2-level Plackett-Burman design in the smallest supported number of runs (a multiple of 4) above the number of factors.
+    # Returns coded levels.
+    k = len(factors)
+    sizes = sorted(set(PB_GENERATORS) | {2 ** i for i in range(2, 8)})
+    n = next((s for s in sizes if s > k), None)
+    if n is None:
+        raise ValueError(f"Too many factors ({k}) for a Plackett-Burman design")
+    if n in PB_GENERATORS:
+        first = np.array([1 if c == "+" else -1 for c in PB_GENERATORS[n]])
+        rows = np.array([np.roll(first, i) for i in range(n - 1)] + [-np.ones(n - 1)])
+    else:
+        rows = _hadamard(n)[:, 1:]
+    return rows[:, :k]
+
+
+def latin_hypercube(factors: dict, runs: int, seed: int = 0, candidates: int = 20):
+    # Space-filling design: each factor's range is cut into `runs` equal strata and each stratum is used once. Of `candidates`
+    # random designs, the one whose closest two runs are furthest apart (maximin) is kept. Returns coded levels.
+    rng = np.random.default_rng(seed)
+    best, best_dist = None, -1.0
+    for _ in range(candidates if runs <= 1000 else 1): # The pairwise distances of large designs cost more than they gain.
+        u = (np.argsort(rng.uniform(size=(len(factors), runs)), axis=1).T + rng.uniform(size=(runs, len(factors)))) / runs
+        if runs <= 1000:
+            d = np.sum((u[:, None] - u[None]) ** 2, axis=-1)
+            dist = d[np.triu_indices(runs, 1)].min() if runs > 1 else 0.0
+        else:
+            dist = 0.0
+        if dist > best_dist:
+            best, best_dist = u, dist
+    return 2 * best - 1
+
+
+def _block_search(x: np.ndarray, order: np.ndarray):
+    # Swaps runs between blocks while any swap lowers the total squared block sums of the columns of x. Returns the new order.
+    x = x[order]
+    order = order.copy()
+    block = np.arange(len(x)) // BLOCK_SIZE
+    for _ in range(10 * len(x)):
+        sums = np.zeros((block.max() + 1, x.shape[1]))
+        np.add.at(sums, block, x)
+        # Change of the total squared block sums if runs i and j swap blocks: 2 d.(S_i - S_j) + 2 |d|^2, with d = x_j - x_i.
+        d = x[None, :, :] - x[:, None, :]
+        s = sums[block]
+        change = 2 * np.einsum("ijc,ijc->ij", d, s[:, None, :] - s[None, :, :]) + 2 * np.einsum("ijc,ijc->ij", d, d)
+        change[block[:, None] == block[None, :]] = 0
+        i, j = np.unravel_index(np.argmin(change), change.shape)
+        if change[i, j] >= -1e-9:
+            break
+        order[[i, j]] = order[[j, i]]
+        x[[i, j]] = x[[j, i]]
+    sums = np.zeros((block.max() + 1, x.shape[1]))
+    np.add.at(sums, block, x)
+    return order, np.sum(sums ** 2)
+
+
+def tip_blocks(coded: np.ndarray, seed: int = 0, interactions: bool = True, restarts: int = 10):
+    # Orders the runs so that each block of 4 consecutive runs (one tip rack) is as balanced as possible: a swap search makes the
+    # sum of every main effect column within each block as close to 0 as it can, and then of every two-factor interaction column
+    # (weighted less, as they cannot all be balanced in small designs), so that differences between tip racks are not confused
+    # with factor effects. The best of several random starts is kept and runs are randomised within each block. Designs larger
+    # than BLOCK_SEARCH_MAX are only randomised. Returns the new order of the runs.
+    rng = np.random.default_rng(seed)
+    n = len(coded)
+    order = rng.permutation(n)
+    if BLOCK_SIZE < n <= BLOCK_SEARCH_MAX:
+        pairs = list(combinations(range(coded.shape[1]), 2)) if interactions else []
+        x = np.column_stack([coded] + [0.1 * coded[:, [i]] * coded[:, [j]] for i, j in pairs])
+        best = np.inf
+        for _ in range(restarts):
+            trial, score = _block_search(x, rng.permutation(n))
+            if score < best - 1e-9:
+                order, best = trial, score
+    blocks = [rng.permutation(order[b:b + BLOCK_SIZE]) for b in range(0, n, BLOCK_SIZE)]
+    return np.concatenate(blocks)
+
+
+def generate(design: str, factors: dict, runs: int = None, levels: int = 2, seed: int = 0, block: bool = True):
+    # Makes a design on the factors {Default_Params key: (low, high)}. design is "full_factorial", "fractional_factorial" (runs
+    # needed), "plackett_burman" or "latin_hypercube" (runs needed). Returns a DataFrame with one column per factor, in run
+    # order, ready for CodeA. With block=True the runs are ordered in balanced blocks of 4, one per tip rack.
+    _check(factors)
+    if design == "full_factorial":
+        coded = full_factorial(factors, levels)
+    elif design == "fractional_factorial":
+        coded = fractional_factorial(factors, runs)
+    elif design == "plackett_burman":
+        coded = plackett_burman(factors)
+    elif design == "latin_hypercube":
+        coded = latin_hypercube(factors, runs, seed)
+    else:
+        raise ValueError(f"Unknown design '{design}'")
+    if block:
+        coded = coded[tip_blocks(coded, seed, interactions=design != "latin_hypercube")]
+    return _uncode(coded, factors)
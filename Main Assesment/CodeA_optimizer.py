@@ -0,0 +1,228 @@
+# Closed-loop optimisation for Code A.
+# Joins the resolved parameter table of a campaign with its Code C results (Gradient and R2 from the fluorescence plates, CV
+# from the absorbance plates), scores each experiment with a desirability between 0 and 1, fits a Gaussian process surrogate
+# over the factors varied in the design and proposes the next batch of 4 experiments by expected improvement. The batch is
+# appended to the design CSV, which must fill whole tip racks, so the 4 new experiment ids take start_col 1, 4, 7 and 10 of a
+# new rack and main_cached only writes protocols for the new rows.
+#
+#   next_batch("pb_design.csv", "pb")      # propose, append to pb_design.csv and write the 4 new protocols
+
+import os
+
+import numpy as np
+import pandas as pd
+
+import CodeA
+import CodeC_analysis
+import CodeC_incremental
+
+BATCH_SIZE = 4               # One experiment per tip block of start_col.
+N_CANDIDATES = 4096          # Random points of the factor space scored by the acquisition function for each proposal.
+SEED = 0
+
+# JMP-style desirability of each response: (goal, low, high). "target" is best half way between low and high, "maximize" is best
+# at high and "minimize" is best at low. An ideal serial dilution gives a log-log gradient of 1, an R2 of 1 and a CV of 0.
+DESIRABILITY = {"Gradient": ("target", 0.8, 1.2),
+                "R2": ("maximize", 0.9, 1.0),
+                "CV": ("minimize", 0.0, 0.2)}
+
+
+def desirability(results: pd.DataFrame, goals: dict = DESIRABILITY):
+    # Overall desirability of each row: the geometric mean of the desirability of each response in results. Responses which
+    # are missing for a row (e.g. no absorbance plate) are left out of its mean.
+    scores = []
+    for k, (goal, low, high) in goals.items():
+        if k not in results:
+            continue
+        x = results[k].to_numpy(dtype=float)
+        if goal == "maximize":
+            d = (x - low) / (high - low)
+        elif goal == "minimize":
+            d = (high - x) / (high - low)
+        else:
+            d = 1 - np.abs(x - (low + high) / 2) / ((high - low) / 2)
+        scores.append(np.clip(d, 1e-3, 1)) # A small floor keeps one poor response from hiding differences in the others.
+    scores = np.array(scores)
+    return np.exp(np.nanmean(np.log(scores), axis=0))
+
+
+def load_history(design_csv: str, prefix: str, results_dir: str = CodeC_incremental.RESULTS_DIR):
+    # The resolved parameter table of a campaign joined to its Code C results and desirability. Experiments without results
+    # (e.g. proposed but not run yet) are dropped.
+    table = CodeA.load_design(design_csv)
+    history = table.copy()
+    results = CodeC_analysis.campaign_results(prefix, results_dir)
+    if len(results):
+        metrics = results.set_index("Experiment Number")
+        history = history.join(metrics[[c for c in metrics.columns if c not in history.columns]])
+    responses = [k for k in DESIRABILITY if k in history]
+    if not responses:
+        raise ValueError(f"No Code C results found for campaign '{prefix}' in {results_dir}")
+    history = history.dropna(subset=responses, how="all")
+    history["Desirability"] = desirability(history)
+    return history
+
+
+def factor_bounds(design_csv: str):
+    # The factors of a design are the Default_Params columns which JMP varied, with the range of values used in the design.
+    design = pd.read_csv(design_csv)
+    bounds = {}
+    for k in design.columns:
+        if k in CodeA.Default_Params:
+            values = pd.to_numeric(design[k], errors="coerce").dropna()
+            if len(values) and values.min() < values.max():
+                bounds[k] = (float(values.min()), float(values.max()))
+    return bounds
+
+
+def _kernel(a: np.ndarray, b: np.ndarray, lengthscales: np.ndarray):
+    # Matern 5/2 kernel with one length scale per factor, on factors scaled to [0, 1].
+    d = np.sqrt(np.sum(((a[:, None, :] - b[None, :, :]) / lengthscales) ** 2, axis=-1)) * np.sqrt(5)
+    return (1 + d + d ** 2 / 3) * np.exp(-d)
+
+
+class GaussianProcess:
+    # A Gaussian process regression model. The length scales and noise are chosen from random candidates by the log marginal
+    # likelihood, which is enough for the tens of points of a campaign and needs nothing beyond NumPy.
+    def __init__(self, x: np.ndarray, y: np.ndarray, seed: int = SEED, n_hyper: int = 64):
+        self.x = x
+        self.y_mean, self.y_std = y.mean(), y.std() or 1.0
+        self.y = (y - self.y_mean) / self.y_std
+        rng = np.random.default_rng(seed)
+        candidates = [(np.full(x.shape[1], 0.5), 1e-2)]
+        candidates += [(np.exp(rng.uniform(np.log(0.05), np.log(3), x.shape[1])), 10 ** rng.uniform(-4, -0.5)) for _ in range(n_hyper)]
+        best = max(candidates, key=lambda c: self._log_likelihood(*c))
+        self.lengthscales, self.noise = best
+        self._factorise()
+
+    def _log_likelihood(self, lengthscales: np.ndarray, noise: float):
+        k = _kernel(self.x, self.x, lengthscales) + noise * np.eye(len(self.x))
+        try:
+            chol = np.linalg.cholesky(k)
+        except np.linalg.LinAlgError:
+            return -np.inf
+        alpha = np.linalg.solve(chol.T, np.linalg.solve(chol, self.y))
+        return -0.5 * self.y @ alpha - np.sum(np.log(np.diag(chol)))
+
+    def _factorise(self):
+        k = _kernel(self.x, self.x, self.lengthscales) + self.noise * np.eye(len(self.x))
+        self.chol = np.linalg.cholesky(k)
+        self.alpha = np.linalg.solve(self.chol.T, np.linalg.solve(self.chol, self.y))
+
+    def predict(self, x: np.ndarray): # Posterior mean and standard deviation, in the units of y.
+        k = _kernel(x, self.x, self.lengthscales)
+        mean = k @ self.alpha
+        v = np.linalg.solve(self.chol, k.T)
+        var = np.clip(1 - np.sum(v ** 2, axis=0), 1e-12, None)
+        return self.y_mean + self.y_std * mean, self.y_std * np.sqrt(var)
+
+    def add(self, x: np.ndarray, y: np.ndarray): # Adds points with the current hyperparameters.
+        self.x = np.vstack([self.x, x])
+        self.y = np.concatenate([self.y, (y - self.y_mean) / self.y_std])
+        self._factorise()
+
+
+def expected_improvement(mean: np.ndarray, std: np.ndarray, best: float, xi: float = 0.01):
+    z = (mean - best - xi) / std
+    cdf = 0.5 * (1 + _erf(z / np.sqrt(2)))
+    pdf = np.exp(-z ** 2 / 2) / np.sqrt(2 * np.pi)
+    return (mean - best - xi) * cdf + std * pdf
+
+
+def _erf(x: np.ndarray): # Abramowitz and Stegun 7.1.26, accurate to 1.5e-7.
+    t = 1 / (1 + 0.3275911 * np.abs(x))
+    y = 1 - t * (0.254829592 + t * (-0.284496736 + t * (1.421413741 + t * (-1.453152027 + t * 1.061405429)))) * np.exp(-x ** 2)
+    return np.sign(x) * y
+
+
+def _candidates(bounds: dict, rng: np.random.Generator, n: int = N_CANDIDATES):
+    # Random points of the factor space, scaled to [0, 1]. Each candidate is resolved as a design row, so a Min or Max which is
+    # not a factor takes its inherited or default value, and candidates which would give a Min greater than its Max or fail
+    # the preflight checks are dropped.
+    u = rng.uniform(size=(n, len(bounds)))
+    table, report = CodeA.resolve_design(pd.DataFrame(_unscale(u, bounds), columns=list(bounds)))
+    bad = {row for row, lo, hi, a, b in report["bad_ranges"]} | {row for row, problem in report["preflight"] if row is not None}
+    return u[~table.index.isin(bad)]
+
+
+def _scale(x: np.ndarray, bounds: dict):
+    lo, hi = np.array(list(bounds.values())).T
+    return (x - lo) / (hi - lo)
+
+
+def _unscale(u: np.ndarray, bounds: dict):
+    lo, hi = np.array(list(bounds.values())).T
+    x = lo + u * (hi - lo)
+    for j, k in enumerate(bounds):
+        if CodeA.PARAM_TYPES[k] is int:
+            x[:, j] = np.round(x[:, j])
+    return x
+
+
+def propose_batch(history: pd.DataFrame, bounds: dict, batch_size: int = BATCH_SIZE, seed: int = SEED):
+    # Proposes batch_size new design rows. Each row maximises expected improvement of the desirability; after each pick the
+    # surrogate assumes the predicted value was measured there (the kriging believer), which spreads the batch out.
+    rng = np.random.default_rng(seed)
+    x = _scale(history[list(bounds)].to_numpy(dtype=float), bounds)
+    y = history["Desirability"].to_numpy(dtype=float)
+    candidates = _candidates(bounds, rng)
+    picks = []
+
+    if len(x) < 2: # Not enough results for a surrogate yet, so the batch is spread as far apart as possible.
+        for _ in range(batch_size):
+            taken = np.vstack([x] + picks)
+            spread = np.min(np.linalg.norm(candidates[:, None] - taken[None], axis=-1), axis=1) if len(taken) else np.zeros(len(candidates))
+            picks.append(candidates[[np.argmax(spread)]])
+    else:
+        model = GaussianProcess(x, y, seed)
+        best = y.max()
+        for _ in range(batch_size):
+            mean, std = model.predict(candidates)
+            ei = expected_improvement(mean, std, best)
+            i = np.argmax(ei)
+            picks.append(candidates[[i]])
+            model.add(candidates[[i]], mean[[i]])
+            candidates = np.delete(candidates, i, axis=0)
+
+    rows = _unscale(np.vstack(picks), bounds)
+    batch = pd.DataFrame(rows, columns=list(bounds))
+    for k in bounds:
+        batch[k] = batch[k].astype(CodeA.PARAM_TYPES[k]) if CodeA.PARAM_TYPES[k] is int else batch[k].round(3)
+    if len(x) >= 2:
+        mean, std = GaussianProcess(x, y, seed).predict(_scale(rows, bounds))
+        batch["Predicted_Desirability"] = mean.round(3)
+    return batch
+
+
+def append_batch(design_csv: str, batch: pd.DataFrame):
+    # Adds the proposed rows to the end of the design. The design must fill whole tip racks, so a batch of 4 starts a new rack
+    # and takes start_col 1, 4, 7 and 10. Columns which are not in the batch are left blank and inherit as usual. The new design
+    # is resolved and checked before the file is replaced, so an invalid batch leaves the design as it was.
+    design = pd.read_csv(design_csv, dtype=str, keep_default_na=False)
+    if len(design) % BATCH_SIZE:
+        raise ValueError(f"{design_csv} has {len(design)} experiments, which do not fill whole tip racks of {BATCH_SIZE}. "
+                         f"Add or remove rows so the next batch starts on start_col 1")
+    new = batch.drop(columns=["Predicted_Desirability"], errors="ignore").astype(str)
+    design = pd.concat([design, new], ignore_index=True).fillna("")
+    CodeA.load_design(design)
+    tmp_path = design_csv + ".tmp"
+    design.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, design_csv) # Replaces the design in one step so an interrupted run cannot leave it half-written.
+    first = len(design) - len(new) + 1
+    return list(range(first, len(design) + 1))
+
+
+def next_batch(design_csv: str, prefix: str, results_dir: str = CodeC_incremental.RESULTS_DIR, out_dir: str = ".",
+               bounds: dict = None, batch_size: int = BATCH_SIZE, seed: int = SEED):
+    # One step of the loop: reads the results of the campaign, proposes the next batch, appends it to the design and writes
+    # its protocols with main_cached. Returns the proposed rows indexed by their new experiment ids.
+    history = load_history(design_csv, prefix, results_dir)
+    bounds = bounds or factor_bounds(design_csv)
+    batch = propose_batch(history, bounds, batch_size, seed)
+    batch.index = pd.Index(append_batch(design_csv, batch), name="experiment_id")
+
+    best = history["Desirability"].idxmax()
+    print(f"{len(history)} experiments with results, best desirability {history['Desirability'].max():.3f} (experiment {best})")
+    print(batch.to_string())
+    CodeA.main_cached(design_csv, out_dir)
+    return batch
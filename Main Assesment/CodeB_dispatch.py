@@ -0,0 +1,330 @@
+# Dispatches the Code B protocols written by Code A to several OT-2 robots at once, through the robot HTTP API (port 31950).
+# Protocols are queued in experiment order. Each robot takes the next protocol whose tip columns are still unused on its tip rack,
+# so every robot uses its rack in order (start_col 1, 4, 7, 10) and asks for a new rack when it is used up. Uploads, starts and
+# status checks of all robots overlap, and the status of every experiment is written to dispatch_status.json as it changes.
+# StandInRobot serves the same API locally, with runs which take the runtime predicted by CodeB_simulator, so the dispatcher can
+# be tested and benchmarked without robots. Only the standard library is used.
+#
+#   python CodeB_dispatch.py --dir protocols --robots 169.254.10.1 169.254.10.2
+#   python CodeB_dispatch.py --dir protocols --stand-in 3 --speed 1000     # offline, on 3 local stand-in robots
+
+import argparse
+import ast
+import asyncio
+import glob
+import json
+import os
+import re
+import time
+import uuid
+
+import CodeA
+import CodeB_simulator
+
+ROBOT_PORT = 31950                           # Port of the robot HTTP API.
+API_VERSION = "3"                            # Opentrons-Version header, required by the robot server.
+POLL_INTERVAL = 5.0                          # s between run status checks.
+TIMEOUT = 60.0                               # s allowed for each request.
+STATUS_FILE = "dispatch_status.json"
+FINISHED = {"succeeded", "failed", "stopped"} # Run statuses after which the robot is free.
+REASONS = {200: "OK", 201: "Created", 400: "Bad Request", 404: "Not Found", 409: "Conflict"}
+
+
+def _parse_message(raw: bytes):
+    # Splits an HTTP request or response into its first line, headers (lower case names) and body.
+    head, _, body = raw.partition(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    headers = {k.strip().lower(): v.strip() for k, _, v in (line.partition(":") for line in lines[1:])}
+    if headers.get("transfer-encoding") == "chunked":
+        chunks = []
+        while True:
+            size, _, body = body.partition(b"\r\n")
+            size = int(size.split(b";")[0], 16)
+            if size == 0:
+                break
+            chunks.append(body[:size])
+            body = body[size + 2:]
+        body = b"".join(chunks)
+    elif "content-length" in headers:
+        body = body[:int(headers["content-length"])]
+    return lines[0], headers, body
+
+
+async def _http(host: str, port: int, method: str, path: str, body: bytes = b"", content_type: str = "application/json"):
+    # One request on its own connection. Returns the status code and the JSON body (None if there is none).
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), TIMEOUT)
+    try:
+        head = (f"{method} {path} HTTP/1.1\r\nHost: {host}:{port}\r\nOpentrons-Version: {API_VERSION}\r\n"
+                f"Content-Type: {content_type}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n")
+        writer.write(head.encode() + body)
+        await writer.drain()
+        start, headers, data = _parse_message(await asyncio.wait_for(reader.read(), TIMEOUT))
+    finally:
+        writer.close()
+    return int(start.split()[1]), json.loads(data) if data else None
+
+
+def _multipart(field: str, filename: str, content: bytes): # A multipart/form-data body with one file, and its content type.
+    boundary = uuid.uuid4().hex
+    body = (f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+            f"Content-Type: text/x-python\r\n\r\n").encode() + content + f"\r\n--{boundary}--\r\n".encode()
+    return body, f"multipart/form-data; boundary={boundary}"
+
+
+def _read_multipart(body: bytes, content_type: str): # The (filename, content) of each file in a multipart/form-data body.
+    boundary = content_type.split("boundary=")[-1].strip('"').encode()
+    files = []
+    for part in body.split(b"--" + boundary)[1:-1]:
+        head, _, content = part.strip(b"\r\n").partition(b"\r\n\r\n")
+        match = re.search(rb'filename="([^"]*)"', head)
+        if match:
+            files.append((match.group(1).decode(), content))
+    return files
+
+
+class Robot:
+    # One OT-2, addressed as "host" or "host:port". next_col is the first unused tip column of the rack on its deck.
+    def __init__(self, address: str, next_col: int = 1):
+        host, _, port = address.partition(":")
+        self.host, self.port = host, int(port or ROBOT_PORT)
+        self.name = address
+        self.next_col = next_col
+
+    async def _call(self, method: str, path: str, body: bytes = b"", content_type: str = "application/json"):
+        status, data = await _http(self.host, self.port, method, path, body, content_type)
+        if status >= 400:
+            raise RuntimeError(f"{method} {path} returned {status}: {data}")
+        return data["data"]
+
+    async def upload(self, path: str): # Uploads a protocol file and returns its protocol id.
+        with open(path, "rb") as f:
+            body, content_type = _multipart("files", os.path.basename(path), f.read())
+        return (await self._call("POST", "/protocols", body, content_type))["id"]
+
+    async def start(self, protocol_id: str): # Creates a run of an uploaded protocol, starts it and returns its run id.
+        run = await self._call("POST", "/runs", json.dumps({"data": {"protocolId": protocol_id}}).encode())
+        await self._call("POST", f"/runs/{run['id']}/actions", json.dumps({"data": {"actionType": "play"}}).encode())
+        return run["id"]
+
+    async def status(self, run_id: str): # e.g. 'running', 'paused', 'succeeded', 'failed' or 'stopped'.
+        return (await self._call("GET", f"/runs/{run_id}"))["status"]
+
+
+def _start_col(path: str): # The start_col in the PARAMS (or the first PARAMS of PARAMS_LIST) of a protocol file.
+    with open(path) as f:
+        match = re.search(r"^PARAMS(?:_LIST)? = (.*)$", f.read(), re.M)
+    if match is None:
+        raise ValueError(f"{path} has no PARAMS")
+    params = ast.literal_eval(match.group(1))
+    return int((params[0] if isinstance(params, list) else params)["start_col"])
+
+
+def load_jobs(out_dir: str = "."):
+    # (experiment_id, protocol path, start_col) of each protocol written by CodeA.main, main_parallel or main_cached in out_dir,
+    # in experiment order. Experiments which share a protocol (main_cached) are each run.
+    manifest_path = os.path.join(out_dir, CodeA.MANIFEST_FILE)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            files = {experiment_id: e["file"] for experiment_id, e in json.load(f)["experiments"].items()}
+    else:
+        files = {re.search(r"_exp_(\w+)\.py$", path).group(1): os.path.basename(path)
+                 for path in glob.glob(os.path.join(out_dir, "serial_dilution_*_exp_*.py"))}
+    cols = {filename: _start_col(os.path.join(out_dir, filename)) for filename in set(files.values())}
+    order = sorted(files, key=lambda experiment_id: (0, int(experiment_id)) if experiment_id.isdigit() else (1, experiment_id))
+    return [(experiment_id, os.path.join(out_dir, files[experiment_id]), cols[files[experiment_id]]) for experiment_id in order]
+
+
+async def _ask_reload(robot: Robot):
+    await asyncio.get_running_loop().run_in_executor(None, input, f"Put a new tip rack on {robot.name} and press Enter ")
+
+
+async def dispatch(jobs: list, robots: list, poll: float = POLL_INTERVAL, status_path: str = STATUS_FILE, on_reload=_ask_reload):
+    # Runs every (experiment_id, path, start_col) in jobs on the robots. A free robot takes the first queued job which starts at its
+    # next tip column, or else the first which starts after it. When no queued job fits on its rack, on_reload(robot) is awaited
+    # (by default the operator replaces the rack and presses Enter) and the robot starts again from column 1. A robot which cannot
+    # be reached is left out and its job goes back to the queue. Returns {experiment_id: status of its run}.
+    pending = list(jobs)
+    status = {}
+    reload_lock = asyncio.Lock() # One operator prompt at a time.
+    t0 = time.perf_counter()
+
+    def save():
+        tmp_path = status_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(status, f, indent=1)
+        os.replace(tmp_path, status_path)
+
+    def take(robot: Robot): # Runs between awaits, so two robots cannot take the same job.
+        fits = [job for job in pending if job[2] >= robot.next_col]
+        if not fits:
+            return None
+        job = next((job for job in fits if job[2] == robot.next_col), fits[0])
+        pending.remove(job)
+        return job
+
+    async def worker(robot: Robot):
+        while pending:
+            job = take(robot)
+            if job is None:
+                async with reload_lock:
+                    if not pending: # The other robots took the rest while this one waited for the operator.
+                        break
+                    await on_reload(robot)
+                    robot.next_col = 1 # The new rack is used from its first column again.
+                continue
+            experiment_id, path, start_col = job
+            entry = status[experiment_id] = {"robot": robot.name, "file": os.path.basename(path), "start_col": start_col, "status": "uploading"}
+            save()
+            try:
+                run_id = await robot.start(await robot.upload(path))
+            except (OSError, RuntimeError, asyncio.TimeoutError) as error:
+                pending.insert(0, job) # The run never started, so another robot can take it.
+                entry.update(status="not started", error=str(error))
+                save()
+                print(f"{robot.name}: {error}. No more experiments will be sent to this robot.")
+                return
+            robot.next_col = start_col + 3
+            entry.update(run_id=run_id, status="running", started=time.time())
+            save()
+            print(f"{robot.name}: started exp {experiment_id} (tip columns {start_col}-{start_col + 2})")
+
+            while entry["status"] not in FINISHED:
+                await asyncio.sleep(poll)
+                try:
+                    entry["status"] = await robot.status(run_id)
+                except (OSError, RuntimeError, asyncio.TimeoutError) as error:
+                    entry.update(status="unknown", error=str(error))
+                    save()
+                    print(f"{robot.name}: lost exp {experiment_id} ({error}). No more experiments will be sent to this robot.")
+                    return
+            entry["finished"] = time.time()
+            save()
+            print(f"{robot.name}: exp {experiment_id} {entry['status']} ({entry['finished'] - entry['started']:.0f} s)")
+
+    await asyncio.gather(*(worker(robot) for robot in robots))
+    save()
+    counts = {}
+    for entry in status.values():
+        counts[entry["status"]] = counts.get(entry["status"], 0) + 1
+    print(f"Dispatched {len(status)} of {len(jobs)} experiments to {len(robots)} robots in {time.perf_counter() - t0:.1f} s: "
+          + ", ".join(f"{n} {k}" for k, n in counts.items()))
+    if pending:
+        print(f"{len(pending)} experiments were not run: no robot could be reached")
+    return status
+
+
+class StandInRobot:
+    # Local stand-in for the OT-2 robot server, serving the requests made by Robot. Each run takes the runtime CodeB_simulator
+    # predicts for its protocol divided by speed, and protocols which fail in the simulator give failed runs. Like the robot,
+    # it holds one active run at a time.
+    def __init__(self, port: int = 0, speed: float = 1.0, host: str = "127.0.0.1"):
+        self.host, self.port, self.speed = host, port, speed
+        self.protocols = {}
+        self.runs = {}
+        self.active = None
+        self.server = None
+
+    @property
+    def address(self):
+        return f"{self.host}:{self.port}"
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+            start, headers, _ = _parse_message(head)
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+            method, path, _ = start.split(" ", 2)
+            if "opentrons-version" not in headers:
+                code, data = 400, {"errors": [{"detail": "Missing Opentrons-Version header"}]}
+            else:
+                code, data = self._route(method, path, headers, body)
+        except (asyncio.IncompleteReadError, ValueError, KeyError) as error:
+            code, data = 400, {"errors": [{"detail": str(error)}]}
+        payload = json.dumps(data).encode()
+        writer.write(f"HTTP/1.1 {code} {REASONS[code]}\r\nContent-Type: application/json\r\nContent-Length: {len(payload)}\r\n"
+                     f"Connection: close\r\n\r\n".encode() + payload)
+        await writer.drain()
+        writer.close()
+
+    def _route(self, method: str, path: str, headers: dict, body: bytes):
+        parts = path.strip("/").split("/")
+        if method == "GET" and parts == ["health"]:
+            return 200, {"name": f"stand-in {self.port}", "robot_model": "OT-2 Standard", "api_version": "stand-in"}
+        if method == "POST" and parts == ["protocols"]:
+            (filename, code), = _read_multipart(body, headers["content-type"])
+            protocol = {"id": uuid.uuid4().hex, "files": [{"name": filename, "role": "main"}], "protocolType": "python"}
+            try:
+                runtime = CodeB_simulator.run_protocol(CodeB_simulator.load_protocol(code.decode(), filename)["run"])["runtime"]
+                self.protocols[protocol["id"]] = (protocol, runtime, None)
+            except Exception as error: # The robot's analysis of a protocol which fails to run.
+                self.protocols[protocol["id"]] = (protocol, 0.0, repr(error))
+            return 201, {"data": protocol}
+        if method == "POST" and parts == ["runs"]:
+            protocol_id = json.loads(body)["data"]["protocolId"]
+            if protocol_id not in self.protocols:
+                return 404, {"errors": [{"detail": f"Protocol {protocol_id} not found"}]}
+            if self.active is not None and self.runs[self.active]["status"] not in FINISHED:
+                return 409, {"errors": [{"detail": "Another run is active"}]}
+            run = {"id": uuid.uuid4().hex, "protocolId": protocol_id, "status": "idle", "current": True, "errors": []}
+            if self.active is not None:
+                self.runs[self.active]["current"] = False
+            self.runs[run["id"]] = run
+            self.active = run["id"]
+            return 201, {"data": run}
+        if len(parts) >= 2 and parts[0] == "runs" and parts[1] in self.runs:
+            run = self.runs[parts[1]]
+            if method == "GET" and len(parts) == 2:
+                return 200, {"data": run}
+            if method == "POST" and parts[2:] == ["actions"] and json.loads(body)["data"]["actionType"] == "play":
+                if run["status"] != "idle":
+                    return 409, {"errors": [{"detail": f"Run is {run['status']}"}]}
+                protocol, runtime, error = self.protocols[run["protocolId"]]
+                run.update(status="running", startedAt=time.time())
+                if error:
+                    run.update(status="failed", errors=[{"detail": error}])
+                else:
+                    asyncio.get_running_loop().call_later(runtime / self.speed, run.update, {"status": "succeeded", "completedAt": time.time() + runtime / self.speed})
+                return 201, {"data": {"id": uuid.uuid4().hex, "actionType": "play"}}
+        return 404, {"errors": [{"detail": f"{method} {path} not found"}]}
+
+
+async def _replace_rack(robot: Robot): # Reloads of the stand-in robots need no operator.
+    print(f"{robot.name}: tip rack replaced")
+
+
+async def dispatch_stand_in(jobs: list, n_robots: int = 3, speed: float = 1000.0, poll: float = 0.05, status_path: str = STATUS_FILE):
+    # Runs the jobs on n_robots local stand-in robots, which run speed times faster than the simulator predicts.
+    stand_ins = [await StandInRobot(speed=speed).start() for _ in range(n_robots)]
+    try:
+        return await dispatch(jobs, [Robot(s.address) for s in stand_ins], poll, status_path, on_reload=_replace_rack)
+    finally:
+        for s in stand_ins:
+            await s.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the protocols written by Code A on several OT-2 robots at once.")
+    parser.add_argument("--dir", default=".", help="directory of the protocols (and protocol_manifest.json of main_cached)")
+    parser.add_argument("--robots", nargs="+", default=[], help="robot addresses, host or host:port")
+    parser.add_argument("--stand-in", type=int, default=0, help="run on this many local stand-in robots instead")
+    parser.add_argument("--speed", type=float, default=1000.0, help="how many times faster than real time the stand-in robots run")
+    parser.add_argument("--poll", type=float, default=None, help=f"s between status checks (default {POLL_INTERVAL}, 0.05 for stand-ins)")
+    args = parser.parse_args()
+
+    jobs = load_jobs(args.dir)
+    status_path = os.path.join(args.dir, STATUS_FILE)
+    if args.stand_in:
+        asyncio.run(dispatch_stand_in(jobs, args.stand_in, args.speed, args.poll or 0.05, status_path))
+    elif args.robots:
+        asyncio.run(dispatch(jobs, [Robot(address) for address in args.robots], args.poll or POLL_INTERVAL, status_path))
+    else:
+        parser.error("give --robots or --stand-in")
@@ -0,0 +1,141 @@
+# Monte Carlo model of the errors of the Code B serial dilution.
+# Follows the volume and amount of fluorescein in every well of the plate through the steps of the protocol (fluorescein and PBS
+# aliquots, 10 transfers with mixing, removal of 100 uL from column 11), with a random volume error on every transfer. The bias and
+# CV of each transfer depend on the parameters of its step. Many replicate plates of many parameter sets are simulated at once,
+# and each replicate is analysed as in Code C, giving the expected distribution of the gradient, R2 and CV of each row of a design.
+# Rows with a low predicted desirability can be removed before they cost plates.
+#
+# The error model is a starting point, not a calibration of a particular robot. Fit ERROR_MODEL to the results of real plates
+# (e.g. by comparing predict() with the Code C results of a finished campaign) before relying on the predictions.
+
+import numpy as np
+import pandas as pd
+
+import CodeA
+import CodeA_optimizer
+import CodeC_fit
+
+N_REPS = 200     # Replicate plates simulated for each parameter set.
+CHUNK = 32       # Parameter sets simulated at a time, which bounds memory to about CHUNK * N_REPS * 96 values per array.
+CHANNELS = 8     # Rows A-H, one per channel of the p300 multi.
+COLUMNS = 12
+
+ERROR_MODEL = {
+    "cv": 0.01,                 # CV of a transfer at rate 1.
+    "cv_per_rate": 0.01,        # CV added for each unit of (aspiration rate + dispense rate) above 2.
+    "cv_per_mm": 0.002,         # CV added for each mm the liquid is dispensed from above 1 mm.
+    "low_height": 0.5,          # mm. Aspirating below this height can draw air or seal the tip on the well bottom...
+    "low_height_cv": 0.02,      # ...which adds this CV.
+    "retention": 0.005,         # Fraction of each dispense left as a film in the tip at dispense rate 1 (a negative bias).
+    "retention_per_rate": 0.01, # Extra fraction retained for each unit of dispense rate above 1.
+    "multi_dispense_cv": 0.005, # CV added for each extra dispense made from one aspiration.
+    "mix_rate": 1.5,            # Mixing efficiency is 1 - exp(-mix_rate * repetitions * fraction * mix dispense rate).
+    "mix_cv": 0.15,             # CV of the concentration aspirated from a well which has not been mixed at all.
+    "droplet": 0.5,             # uL left on the outside of the tip after mixing, carried into the next well...
+    "touch_tip": 0.9,           # ...of which this fraction is removed by a touch tip with radius 1.
+}
+
+
+def _transfer(asp_rate, disp_rate, asp_height, disp_height, model: dict):
+    # Bias and CV of a transfer for each row, from the rates and heights of its step.
+    cv = model["cv"] + model["cv_per_rate"] * np.clip(asp_rate + disp_rate - 2, 0, None)
+    cv = cv + model["cv_per_mm"] * np.clip(disp_height - 1, 0, None) + np.where(asp_height < model["low_height"], model["low_height_cv"], 0)
+    bias = -(model["retention"] + model["retention_per_rate"] * np.clip(disp_rate - 1, 0, None))
+    return bias, cv
+
+
+def step_errors(table: pd.DataFrame, model: dict = ERROR_MODEL):
+    # Bias and CV of the aliquot and dilution transfers, CV of the concentration left by incomplete mixing and droplet carry-over
+    # of each row of a resolved table.
+    t = {k: table[k].to_numpy(dtype=float) for k in table.columns}
+    aliquot_bias, aliquot_cv = _transfer(t["Aliquot_Aspiration_Rate"], t["Aliquot_Dispense_Rate"], t["Aliquot_Aspiration_Height"],
+                                         t["Aliquot_Dispense_Height"], model)
+    dilution_bias, dilution_cv = _transfer(t["Dilution_Aspiration_Rate"], t["Dilution_Dispense_Rate"], t["Dilution_Aspiration_Height"],
+                                           t["Dilution_Dispense_Height"], model)
+    mixing = 1 - np.exp(-model["mix_rate"] * t["Mixing_Repetitions"] * t["Mixing_Fraction"] * t["Mix_Dispense_Rate"])
+    return {
+        "aliquot_bias": aliquot_bias,
+        "aliquot_cv": aliquot_cv,
+        "pbs_cv": aliquot_cv + model["multi_dispense_cv"] * (t["Aliquot_Dispenses_Per_Aspirate"] - 1),
+        "dilution_bias": dilution_bias,
+        "dilution_cv": dilution_cv,
+        "mix_cv": (1 - mixing) * model["mix_cv"],
+        "carry_over": model["droplet"] * (1 - model["touch_tip"] * np.clip(t["Touch_Tip_Radius"], 0, 1)),
+    }
+
+
+def simulate_plates(errors: dict, n_reps: int = N_REPS, seed: int = 0):
+    # Simulates n_reps plates for each row of errors (a slice of step_errors). Returns the fluorescein amount and the volume of
+    # every well that is read, each of shape (rows, n_reps, 8, 11).
+    rng = np.random.default_rng(seed)
+    v = CodeA.TEMPLATE_VOLUMES
+    e = {k: x[:, None, None] for k, x in errors.items()} # Broadcast over replicates and channels.
+    shape = (len(errors["mix_cv"]), n_reps, CHANNELS)
+    volume = np.zeros(shape + (COLUMNS,))
+    amount = np.zeros(shape + (COLUMNS,))
+
+    def draw(nominal, bias, cv):
+        return np.clip(nominal * (1 + bias + cv * rng.standard_normal(shape)), 0, None)
+
+    volume[..., 0] = draw(v["fluorescein_volume"], e["aliquot_bias"], e["aliquot_cv"])
+    amount[..., 0] = volume[..., 0] * CodeC_fit.FLUOR_CONC[0]
+    for col in range(1, COLUMNS):
+        volume[..., col] = draw(v["pbs_volume"], e["aliquot_bias"], e["pbs_cv"])
+
+    for col in range(COLUMNS - 2): # Transfers from column 1 to 2, ..., 10 to 11, each followed by mixing in the new well.
+        conc = amount[..., col] / volume[..., col]
+        if col > 0: # Column 1 is pure fluorescein, the others were mixed after the last transfer.
+            conc = conc * np.clip(1 + e["mix_cv"] * rng.standard_normal(shape), 0, None)
+        moved = np.minimum(draw(v["dilution_volume"], e["dilution_bias"], e["dilution_cv"]), volume[..., col])
+        moved_amount = np.minimum(moved * conc, amount[..., col])
+        volume[..., col] -= moved
+        amount[..., col] -= moved_amount
+        # Droplets from mixing are carried over from the second transfer on. They leave the source well with the transfer.
+        carried = np.minimum(e["carry_over"] * (col > 0), volume[..., col])
+        carried_amount = np.minimum(carried * conc, amount[..., col])
+        volume[..., col] -= carried
+        amount[..., col] -= carried_amount
+        volume[..., col + 1] += moved + carried
+        amount[..., col + 1] += moved_amount + carried_amount
+
+    last = COLUMNS - 2 # 100 uL of column 11 goes to waste, which leaves 100 uL in every well which is read.
+    conc = amount[..., last] / volume[..., last]
+    removed = np.minimum(draw(v["dilution_volume"], e["dilution_bias"], e["dilution_cv"]), volume[..., last])
+    volume[..., last] -= removed
+    amount[..., last] -= removed * conc
+    return amount[..., :COLUMNS - 1], volume[..., :COLUMNS - 1]
+
+
+def predict(table: pd.DataFrame, n_reps: int = N_REPS, seed: int = 0, model: dict = ERROR_MODEL):
+    # Mean, standard deviation and 5th/95th percentiles of the gradient, R2 and CV of each row of a resolved table (CodeA.load_design),
+    # and the mean desirability of its replicates (CodeA_optimizer.DESIRABILITY).
+    errors = step_errors(table, model)
+    out = {}
+    for start in range(0, len(table), CHUNK):
+        chunk = {k: x[start:start + CHUNK] for k, x in errors.items()}
+        amount, volume = simulate_plates(chunk, n_reps, seed + start)
+        gradient, intercept, r2 = CodeC_fit.fit_experiments(amount) # The fluorescence signal is proportional to the amount in the well.
+        wells = volume.reshape(volume.shape[:2] + (-1,))           # The absorbance difference is proportional to the volume in the well.
+        cv = wells.std(axis=-1, ddof=1) / wells.mean(axis=-1)
+        metrics = {"Gradient": gradient, "R2": r2, "CV": cv}
+        metrics["Desirability"] = CodeA_optimizer.desirability(pd.DataFrame({k: x.ravel() for k, x in metrics.items()})).reshape(gradient.shape)
+        for k, x in metrics.items():
+            out.setdefault(f"{k}_Mean", []).append(x.mean(axis=1))
+            out.setdefault(f"{k}_SD", []).append(x.std(axis=1))
+            out.setdefault(f"{k}_P05", []).append(np.percentile(x, 5, axis=1))
+            out.setdefault(f"{k}_P95", []).append(np.percentile(x, 95, axis=1))
+    return pd.DataFrame({k: np.concatenate(x) for k, x in out.items()}, index=table.index)
+
+
+def screen(design_csv: str = CodeA.DESIGN_CSV, out_csv: str = None, min_desirability: float = 0.5, n_reps: int = N_REPS):
+    # Writes a copy of the JMP table without the rows whose mean predicted desirability is below min_desirability, with the
+    # predictions as extra columns. Returns the predictions of every row.
+    design = pd.read_csv(design_csv, dtype=str, keep_default_na=False)
+    predictions = predict(CodeA.load_design(design_csv), n_reps)
+    keep = (predictions["Desirability_Mean"] >= min_desirability).to_numpy()
+    for k in ["Gradient_Mean", "R2_Mean", "CV_Mean", "Desirability_Mean"]:
+        design[f"Predicted_{k[:-5]}"] = predictions[k].round(4).to_numpy()
+    out_csv = out_csv or design_csv.rsplit(".", 1)[0] + "_screened.csv"
+    design[keep].to_csv(out_csv, index=False)
+    print(f"Wrote {out_csv}: kept {keep.sum()} of {len(design)} rows with predicted desirability >= {min_desirability}")
+    return predictions
@@ -0,0 +1,174 @@
+# Consumables planner for a whole campaign of Code B runs.
+# Each run takes 3 tip columns, 200 uL of fluorescein from each well of reservoir column 1, 11 x 100 uL of PBS from each well of
+# column 6 (plus the disposal volume in multi-dispense mode) and puts 100 uL (plus the disposal volume) into each well of column 12.
+# The planner orders the experiments of a resolved design into tip racks, follows the tips, reagents and waste of each robot run by
+# run, and writes a run sheet which says what the operator must do before each run. Refills and waste emptying are moved forward to
+# the tip rack changes where they can be, so the robot stops as few times as possible.
+#
+#   sheet = plan(DESIGN_CSV, robots=2, runtimes=CodeB_simulator.simulate_table(CodeA.load_design(DESIGN_CSV))["Predicted_Runtime"])
+
+import numpy as np
+import pandas as pd
+
+import CodeA
+
+RESERVOIR_COLUMNS = {"Fluorescein": 1, "PBS": 6, "Waste": 12}
+OPERATOR_TIME = {"Tips": 60, "Fluorescein": 90, "PBS": 90, "Waste": 120, "Plate": 60} # s the robot waits for each job of the operator.
+RUN_SHEET = "run_sheet.csv"
+
+
+def run_usage(table: pd.DataFrame):
+    # uL taken from (or added to) each well of the reservoir columns by each run of a resolved table (CodeA.load_design).
+    v = CodeA.TEMPLATE_VOLUMES
+    disposal = np.where(table["Aliquot_Dispenses_Per_Aspirate"] > 1, table["Aliquot_Disposal_Volume"], 0)
+    return pd.DataFrame({
+        "start_col": table["start_col"],
+        "Fluorescein": v["fluorescein_volume"],
+        "PBS": [CodeA.pbs_needed(params) for experiment_id, params in CodeA.iter_params(table)],
+        "Waste": v["dilution_volume"] + disposal, # Column 11 is emptied into the waste, and the disposal volume is blown out there.
+    }, index=table.index)
+
+
+def order_runs(table: pd.DataFrame):
+    # Groups the experiments into tip racks, first fit in design order: a rack holds at most one experiment per start column, as
+    # each uses its own 3 columns. This gives the fewest racks the start columns allow. Returns the racks, each a list of
+    # experiment ids in start column order.
+    racks = []
+    for experiment_id, start_col in table["start_col"].items():
+        rack = next((r for r in racks if start_col not in r), None)
+        if rack is None:
+            rack = {}
+            racks.append(rack)
+        rack[start_col] = experiment_id
+    return [[rack[col] for col in sorted(rack)] for rack in racks]
+
+
+def assign_robots(racks: list, robots: int = 1, runtimes: pd.Series = None):
+    # Shares the racks between the robots, each rack to the robot which finishes its earlier racks first (by predicted runtime
+    # if runtimes are given, otherwise by number of runs). Returns a list of racks for each robot.
+    load = np.zeros(robots)
+    plans = [[] for _ in range(robots)]
+    for rack in racks:
+        robot = int(np.argmin(load))
+        plans[robot].append(rack)
+        load[robot] += runtimes.loc[rack].sum() if runtimes is not None else len(rack)
+    return plans
+
+
+def _plan_robot(usage: pd.DataFrame, racks: list, group: bool = True):
+    # Follows the tips, reagents and waste of one robot through its racks. Before each run, a reagent is topped up if it cannot
+    # supply the run, and the waste emptied if it cannot take it. With group=True, whenever the operator is at the robot anyway,
+    # anything which would run out before the next tip rack change is dealt with too. Top-ups fill a well with as many whole runs
+    # as it holds (plus the dead volume), so no reagent is left over at the end. Returns one row per run.
+    cap, dead = CodeA.RESERVOIR_WELL_VOLUME, CodeA.RESERVOIR_DEAD_VOLUME
+    runs = [(r, experiment_id) for r, rack in enumerate(racks, start=1) for experiment_id in rack]
+    need = {k: v.to_numpy() for k, v in usage.loc[[experiment_id for r, experiment_id in runs]].items()}
+    rack_of = np.array([r for r, experiment_id in runs])
+    rack_end = np.searchsorted(rack_of, rack_of, side="right")               # Index after the last run of each run's rack.
+    total = {k: np.concatenate([[0], np.cumsum(need[k])]) for k in usage.columns[1:]} # total[k][i] is the need of runs before i.
+    level = {"Fluorescein": 0.0, "PBS": 0.0, "Waste": 0.0}
+    used = {"Tips": 0, "Fluorescein": 0.0, "PBS": 0.0, "Waste": 0.0}
+    rack_now, next_col = None, CodeA.TIPRACK_COLUMNS + 1
+    rows = []
+    for i, (rack, experiment_id) in enumerate(runs):
+        start_col = int(need["start_col"][i])
+        window = {k: t[rack_end[i]] - t[i] for k, t in total.items()} # This run and the rest of its rack.
+        jobs, notes = [], []
+        if rack != rack_now or start_col < next_col:
+            jobs.append("Tips")
+            notes.append("New tip rack")
+            rack_now, next_col = rack, 1
+        for step in (0, 1): # The second pass adds what can be done early, once the operator has a job at the robot.
+            for k in ("Fluorescein", "PBS"):
+                short = level[k] - need[k][i] < dead
+                early = group and step and jobs and level[k] - window[k] < dead
+                if k not in jobs and (short or early):
+                    last = max(np.searchsorted(total[k], total[k][i] + cap - dead, side="right") - 1, i + 1) # Runs i .. last - 1 fit in the well.
+                    add = dead + total[k][last] - total[k][i] - level[k]
+                    level[k] += add
+                    used[k] += 8 * add
+                    jobs.append(k)
+                    notes.append(f"{k}: add {add:.0f} uL to each well of column {RESERVOIR_COLUMNS[k]}")
+            full = level["Waste"] + need["Waste"][i] > cap
+            early = group and step and jobs and level["Waste"] + window["Waste"] > cap
+            if "Waste" not in jobs and (full or early):
+                notes.append(f"Empty the waste in column {RESERVOIR_COLUMNS['Waste']} ({level['Waste']:.0f} uL per well)")
+                level["Waste"] = 0.0
+                jobs.append("Waste")
+        next_col = start_col + 3
+        level["Fluorescein"] -= need["Fluorescein"][i]
+        level["PBS"] -= need["PBS"][i]
+        level["Waste"] += need["Waste"][i]
+        used["Tips"] += 3
+        used["Waste"] += 8 * need["Waste"][i]
+        rows.append({"Experiment": experiment_id, "Tip_Rack": rack, "start_col": start_col, "Jobs": jobs, "Actions": "; ".join(notes),
+                     "Fluorescein_Left": level["Fluorescein"], "PBS_Left": level["PBS"], "Waste_Level": level["Waste"],
+                     "Tip_Columns_Used": used["Tips"], "Fluorescein_Added": used["Fluorescein"], "PBS_Added": used["PBS"],
+                     "Waste_Total": used["Waste"]})
+    return rows
+
+
+def run_sheet(table: pd.DataFrame, robots: int = 1, runtimes: pd.Series = None, group: bool = True, order: bool = True):
+    # The run sheet of a resolved table: one row per run in the order each robot runs them, with the operator's jobs before the
+    # run, the reservoir levels after it (uL per well) and the running totals (tip columns, and uL over the 8 wells). Pause marks
+    # runs which need more than the jobs done before every run (e.g. a new plate and PBS, when a PBS well only holds one run). With
+    # runtimes (s, by experiment id), Start and End give the hours from the start of the campaign, including the operator's time.
+    usage = run_usage(table)
+    if order:
+        racks = order_runs(table)
+    else: # Design order, with a new rack whenever a start column has been used.
+        racks, rack = [], []
+        for experiment_id, start_col in table["start_col"].items():
+            if rack and start_col <= usage.at[rack[-1], "start_col"]:
+                racks.append(rack)
+                rack = []
+            rack.append(experiment_id)
+        racks += [rack] if rack else []
+
+    sheets = []
+    for robot, robot_racks in enumerate(assign_robots(racks, robots, runtimes), start=1):
+        if not robot_racks:
+            continue
+        sheet = pd.DataFrame(_plan_robot(usage, robot_racks, group))
+        sheet.insert(0, "Robot", robot)
+        sheet.insert(1, "Run", np.arange(1, len(sheet) + 1))
+        if runtimes is not None:
+            wait = np.array([sum(OPERATOR_TIME[job] for job in jobs + ["Plate"]) for jobs in sheet["Jobs"]])
+            end = np.cumsum(wait + runtimes.loc[sheet["Experiment"]].to_numpy())
+            sheet["Start_h"] = (end - runtimes.loc[sheet["Experiment"]].to_numpy()) / 3600
+            sheet["End_h"] = end / 3600
+        sheets.append(sheet)
+    sheet = pd.concat(sheets, ignore_index=True)
+
+    every_run = set.intersection(*(set(jobs) for jobs in sheet["Jobs"].iloc[1:])) if len(sheet) > 1 else set()
+    sheet["Pause"] = [bool(set(jobs) - every_run) for jobs in sheet["Jobs"]]
+    sheet["Pause"] &= sheet["Run"] > 1 # The first run of each robot starts from an empty deck.
+    return sheet
+
+
+def plan(design_csv: str = CodeA.DESIGN_CSV, robots: int = 1, runtimes: pd.Series = None, out_csv: str = RUN_SHEET):
+    # Writes the run sheet of a design and prints the consumables and pause points of the campaign, compared with running the
+    # design in order and refilling only when a reagent runs out.
+    table = CodeA.load_design(design_csv)
+    if runtimes is not None: # CodeB_simulator.simulate_table gives runtimes by experiment id as a string.
+        runtimes = runtimes.set_axis(runtimes.index.astype(int))
+    sheet = run_sheet(table, robots, runtimes)
+    naive = run_sheet(table, robots, runtimes, group=False, order=False)
+    sheet.drop(columns="Jobs").to_csv(out_csv, index=False)
+
+    jobs = pd.Series([job for jobs in sheet["Jobs"] for job in jobs]).value_counts()
+    last = sheet.groupby("Robot").last()
+    print(f"Wrote {out_csv}: {len(sheet)} runs on {sheet['Robot'].nunique()} robots")
+    print(f"Tip racks: {jobs.get('Tips', 0)} ({last['Tip_Columns_Used'].sum()} tip columns)")
+    for k in ("Fluorescein", "PBS"):
+        print(f"{k}: {last[f'{k}_Added'].sum() / 1000:.1f} mL over {jobs.get(k, 0)} fills of reservoir column {RESERVOIR_COLUMNS[k]}")
+    print(f"Waste: {last['Waste_Total'].sum() / 1000:.1f} mL, emptied {jobs.get('Waste', 0)} times")
+    every_run = [k for k in ("PBS", "Fluorescein", "Waste") if jobs.get(k, 0) >= len(sheet)]
+    if every_run:
+        print(f"Before every run: new plate and {', '.join(every_run)}")
+    print(f"Pause points: {sheet['Pause'].sum()} ({naive['Pause'].sum()} in design order without grouping)")
+    if runtimes is not None:
+        print(f"Campaign time: {sheet['End_h'].max():.1f} h ({naive['End_h'].max():.1f} h)")
+    for row in sheet[sheet["Pause"]].itertuples():
+        print(f"  Robot {row.Robot}, before run {row.Run} (exp {row.Experiment}): {row.Actions}")
+    return sheet
@@ -0,0 +1,374 @@
+# Offline simulator for the Code B protocols written by Code A.
+# Runs the generated run(protocol) functions against a light stand-in for the Opentrons ProtocolContext and estimates how long
+# each step takes from the flow rates, rate multipliers, volumes, touch tip speed and the distances moved around the deck.
+# The Opentrons package is not needed. Predicted runtimes can be added to the JMP table as a response column.
+
+import glob
+import json
+import math
+import os
+import random
+import re
+import sys
+import types
+from contextlib import contextmanager
+
+import pandas as pd
+
+import CodeA
+
+# Timing model. These are approximate values for an OT-2 with a p300 multi-channel GEN2 pipette.
+GANTRY_SPEED = 400.0        # mm/s, speed of x/y moves.
+Z_SPEED = 125.0             # mm/s, speed of vertical moves.
+ARC_CLEARANCE = 10.0        # mm above the tallest labware when moving between labware.
+WELL_CLEARANCE = 1.0        # mm above the labware when moving between wells of the same labware.
+DEFAULT_WELL_BOTTOM = 1.0   # mm above the well bottom when a well is passed without .bottom() or .top().
+TIP_PICK_UP_TIME = 3.0      # s to press onto the tips and retract.
+TIP_DROP_TIME = 2.0         # s to eject the tips.
+BLOW_OUT_VOLUME = 20.0      # uL equivalent of the plunger travel during a blow out.
+DEFAULT_FLOW_RATE = 92.86   # uL/s, default aspirate, dispense and blow out flow rate of the p300 multi GEN2.
+MAX_VOLUME = 300.0          # uL, tip capacity.
+
+# Deck slots 1-12 are laid out in 3 columns and 4 rows. Slot 12 holds the fixed trash.
+SLOT_ORIGINS = {slot: ((slot - 1) % 3 * 132.5, (slot - 1) // 3 * 90.5) for slot in range(1, 13)}
+
+# (height, well depth, well diameter) in mm, from the labware definitions.
+LABWARE_GEOMETRY = {
+    'costar3370flatbottomtransparent_96_wellplate_200ul': (14.22, 10.67, 6.86),
+    'opentrons_96_tiprack_300ul': (64.49, 59.3, 5.23),
+    '4ti0136_96_wellplate_2200ul': (42.0, 39.1, 8.2),
+    'opentrons_1_trash_1100ml_fixed': (82.0, 0.0, 80.0),
+}
+DEFAULT_GEOMETRY = (14.22, 10.67, 6.86)
+
+# Well names and their x/y offsets from the labware corner, for the standard 96-well footprint.
+WELL_NAMES = [f"{row}{col}" for col in range(1, 13) for row in "ABCDEFGH"]
+WELL_OFFSETS = {f"{row}{col}": (14.38 + 9 * (col - 1), 74.24 - 9 * r) for col in range(1, 13) for r, row in enumerate("ABCDEFGH")}
+
+PHASES = ["Tips", "Aliquot", "Dilution", "Mix", "Waste"] # Each step is assigned to one of these phases.
+
+
+class Location:
+    def __init__(self, labware, well, x: float, y: float, z: float):
+        self.labware = labware
+        self.well = well
+        self.x = x
+        self.y = y
+        self.z = z
+
+
+class Well:
+    def __init__(self, labware, name: str, x: float, y: float):
+        self.labware = labware
+        self.well_name = name
+        self.x = x
+        self.y = y
+
+    def bottom(self, z: float = 0.0):
+        return Location(self.labware, self, self.x, self.y, self.labware.bottom_z + z)
+
+    def top(self, z: float = 0.0):
+        return Location(self.labware, self, self.x, self.y, self.labware.height + z)
+
+
+class _Wells(dict): # Wells are made the first time they are used, as a protocol only uses a few of the 96 wells of each labware.
+    def __init__(self, labware):
+        super().__init__()
+        self.labware = labware
+
+    def __missing__(self, name: str):
+        dx, dy = WELL_OFFSETS[name]
+        well = self[name] = Well(self.labware, name, self.labware.x + dx, self.labware.y + dy)
+        return well
+
+
+class Labware:
+    def __init__(self, load_name: str, slot):
+        self.load_name = load_name
+        self.height, depth, self.diameter = LABWARE_GEOMETRY.get(load_name, DEFAULT_GEOMETRY)
+        self.bottom_z = self.height - depth
+        self.x, self.y = SLOT_ORIGINS[int(slot)]
+        self._wells = _Wells(self)
+
+    def __getitem__(self, name: str):
+        return self._wells[name]
+
+    def wells_by_name(self):
+        return self._wells
+
+    def wells(self):
+        return [self._wells[name] for name in WELL_NAMES]
+
+    def columns(self):
+        return [[self._wells[f"{row}{col}"] for row in "ABCDEFGH"] for col in range(1, 13)]
+
+
+class FlowRates:
+    def __init__(self):
+        self.aspirate = DEFAULT_FLOW_RATE
+        self.dispense = DEFAULT_FLOW_RATE
+        self.blow_out = DEFAULT_FLOW_RATE
+
+
+class Pipette:
+    def __init__(self, protocol, name: str, mount: str, tip_racks: list):
+        self.protocol = protocol
+        self.name = name
+        self.mount = mount
+        self.tip_racks = tip_racks or []
+        self.nozzle_layout = "ALL"
+        self.flow_rate = FlowRates()
+        self.max_volume = MAX_VOLUME
+        self.current_volume = 0.0
+        self.has_tip = False
+        self.location = Location(None, None, 418.0, 353.0, 205.0) # Home position.
+        self._used_tips = set()
+        self._last_well = None           # Well of the last dispense, while the tip is still working in it (mixing).
+        self._last_phase = "Tips"
+        self._sources = set()            # Labware which liquid is taken from (the reservoir).
+        self._dispensed = set()          # Labware which liquid is added to (the plate).
+
+    # Movement: vertical moves at Z_SPEED and x/y moves at GANTRY_SPEED. Moves between labware arc over the tallest labware.
+    def _move_to(self, loc: Location):
+        cur = self.location
+        xy = math.hypot(loc.x - cur.x, loc.y - cur.y)
+        if xy == 0:
+            t = abs(loc.z - cur.z) / Z_SPEED
+        else:
+            if cur.labware is loc.labware:
+                safe = loc.labware.height + WELL_CLEARANCE
+            else:
+                safe = self.protocol.max_height + ARC_CLEARANCE
+            safe = max(safe, cur.z, loc.z)
+            t = (safe - cur.z) / Z_SPEED + xy / GANTRY_SPEED + (safe - loc.z) / Z_SPEED
+        self.location = loc
+        return t
+
+    def _location(self, location):
+        if location is None:
+            return self.location
+        if isinstance(location, Well):
+            return location.bottom(DEFAULT_WELL_BOTTOM)
+        return location
+
+    def _next_tip(self):
+        for rack in self.tip_racks:
+            for column in rack.columns():
+                if column[0] not in self._used_tips:
+                    return column[0]
+        raise RuntimeError("No tips left in the tip racks")
+
+    def configure_nozzle_layout(self, style, start=None, end=None, front_right=None, back_left=None, tip_racks=None):
+        # Partial tip pickup (CodeA.main_multiplex). The protocols pick their tips explicitly, so only the tip racks change.
+        self.nozzle_layout = style
+        if tip_racks is not None:
+            self.tip_racks = tip_racks
+        return self
+
+    def move_to(self, location):
+        self.protocol._record(self._last_phase, "move_to", self._move_to(self._location(location)))
+        return self
+
+    def pick_up_tip(self, location=None, presses=None, increment=None):
+        well = location if isinstance(location, Well) else (location.well if location is not None else self._next_tip())
+        if well in self._used_tips:
+            self.protocol.warnings.append(f"Tip {well.well_name} was picked up twice")
+        self._used_tips.add(well)
+        t = self._move_to(well.top()) + TIP_PICK_UP_TIME
+        self.has_tip = True
+        self._last_well = None
+        self.protocol._record("Tips", "pick_up_tip", t)
+        return self
+
+    def drop_tip(self, location=None, home_after=None):
+        loc = self._location(location) if location is not None else self.protocol.trash["A1"].top()
+        t = self._move_to(loc) + TIP_DROP_TIME
+        self.has_tip = False
+        self.current_volume = 0.0
+        self._last_well = None
+        self.protocol._record("Tips", "drop_tip", t)
+        return self
+
+    def aspirate(self, volume=None, location=None, rate: float = 1.0):
+        loc = self._location(location)
+        volume = self.max_volume - self.current_volume if volume is None else volume
+        if loc.well is not None and loc.well is self._last_well:
+            phase = "Mix"
+        elif loc.labware in self._sources or loc.labware not in self._dispensed:
+            phase = "Aliquot"
+            self._sources.add(loc.labware)
+        else:
+            phase = "Dilution"
+        if self.current_volume + volume > self.max_volume:
+            self.protocol.warnings.append(f"Aspirating {volume} uL exceeds the {self.max_volume} uL tip")
+        t = self._move_to(loc) + volume / (self.flow_rate.aspirate * rate)
+        self.current_volume += volume
+        self._last_phase = phase
+        self.protocol._record(phase, "aspirate", t)
+        return self
+
+    def dispense(self, volume=None, location=None, rate: float = 1.0, push_out=None):
+        loc = self._location(location)
+        volume = self.current_volume if volume is None else min(volume, self.current_volume) # The pipette can only dispense what it holds.
+        if self._last_phase == "Mix":
+            phase = "Mix"
+        elif loc.labware in self._sources:
+            phase = "Waste"
+        else:
+            phase = self._last_phase
+        t = self._move_to(loc) + volume / (self.flow_rate.dispense * rate)
+        self.current_volume -= volume
+        self._dispensed.add(loc.labware)
+        self._last_well = loc.well
+        self._last_phase = phase
+        self.protocol._record(phase, "dispense", t)
+        return self
+
+    def mix(self, repetitions: int = 1, volume=None, location=None, rate: float = 1.0):
+        for _ in range(repetitions):
+            self.aspirate(volume, location, rate)
+            self.dispense(volume, location, rate)
+        return self
+
+    def blow_out(self, location=None):
+        loc = self.location if location is None else (location.top() if isinstance(location, Well) else location)
+        t = self._move_to(loc) + BLOW_OUT_VOLUME / self.flow_rate.blow_out
+        self.current_volume = 0.0
+        self._last_well = None
+        self.protocol._record(self._last_phase, "blow_out", t)
+        return self
+
+    def touch_tip(self, location=None, radius: float = 1.0, v_offset: float = -1.0, speed: float = 60.0):
+        well = location if isinstance(location, Well) else (location.well if location is not None else self.location.well)
+        t = self._move_to(well.top(v_offset))
+        r = radius * well.labware.diameter / 2
+        t += r * (5 + math.sqrt(2)) / speed # Centre -> right -> left -> back -> front edge of the well.
+        self._last_well = None
+        self.protocol._record(self._last_phase, "touch_tip", t)
+        return self
+
+
+class ProtocolContext:
+    def __init__(self):
+        self.steps = []     # (phase, action, seconds) for every call made by the protocol.
+        self.warnings = []
+        self.labware = []
+        self.trash = Labware('opentrons_1_trash_1100ml_fixed', 12)
+        self.max_height = self.trash.height
+
+    def _record(self, phase: str, action: str, seconds: float):
+        self.steps.append((phase, action, seconds))
+
+    def load_labware(self, load_name: str, location, label=None, namespace=None, version=None):
+        labware = Labware(load_name, location)
+        self.labware.append(labware)
+        self.max_height = max(self.max_height, labware.height)
+        return labware
+
+    def load_instrument(self, instrument_name: str, mount: str, tip_racks=None, replace=False):
+        return Pipette(self, instrument_name, mount, tip_racks)
+
+    def delay(self, seconds: float = 0, minutes: float = 0, msg=None):
+        self._record("Tips", "delay", seconds + 60 * minutes)
+
+    def comment(self, msg: str):
+        pass
+
+    def pause(self, msg=None):
+        pass
+
+    def home(self):
+        pass
+
+    def is_simulating(self):
+        return True
+
+    def summary(self):
+        phases = dict.fromkeys(PHASES, 0.0)
+        actions = {}
+        for phase, action, seconds in self.steps:
+            phases[phase] += seconds
+            actions[action] = actions.get(action, 0.0) + seconds
+        return {"runtime": sum(phases.values()), "phases": phases, "actions": actions, "warnings": self.warnings}
+
+
+@contextmanager
+def _stand_in_opentrons(): # Lets 'from opentrons import protocol_api' in the generated code import this module's stand-ins.
+    protocol_api = types.ModuleType("opentrons.protocol_api")
+    protocol_api.ProtocolContext = ProtocolContext
+    protocol_api.ALL, protocol_api.COLUMN, protocol_api.SINGLE = "ALL", "COLUMN", "SINGLE" # Nozzle layouts for partial tip pickup.
+    opentrons = types.ModuleType("opentrons")
+    opentrons.protocol_api = protocol_api
+    saved = {name: sys.modules.get(name) for name in ("opentrons", "opentrons.protocol_api")}
+    sys.modules.update({"opentrons": opentrons, "opentrons.protocol_api": protocol_api})
+    try:
+        yield
+    finally:
+        for name, module in saved.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+
+def load_protocol(code: str, filename: str = "<protocol>"): # Executes the protocol code and returns its namespace (metadata, PARAMS and run).
+    namespace = {"__name__": "protocol"}
+    with _stand_in_opentrons():
+        exec(compile(code, filename, "exec"), namespace)
+    return namespace
+
+def run_protocol(run, seed: int = 0): # Runs a protocol's run function in a new ProtocolContext and returns the timing summary.
+    random.seed(seed) # The random mix heights are repeatable, so the same protocol always gets the same estimate.
+    protocol = ProtocolContext()
+    run(protocol)
+    return protocol.summary()
+
+def simulate_protocol(path: str):
+    with open(path) as f:
+        return run_protocol(load_protocol(f.read(), path)["run"])
+
+def _row(summary: dict):
+    row = {"Predicted_Runtime": summary["runtime"]}
+    row.update({f"Predicted_{phase}": seconds for phase, seconds in summary["phases"].items()})
+    return row
+
+def simulate_table(table: pd.DataFrame):
+    # Estimates the runtime of every experiment in a resolved table (CodeA.load_design) without writing protocol files.
+    # The generated run() reads PARAMS from its module, so the protocol is compiled once and PARAMS is swapped for each row.
+    namespace = None
+    rows = {}
+    for experiment_id, params in CodeA.iter_params(table):
+        if namespace is None:
+            namespace = load_protocol(CodeA.make_protocol_code(params, experiment_id))
+        namespace["PARAMS"] = params
+        rows[experiment_id] = _row(run_protocol(namespace["run"]))
+    return pd.DataFrame.from_dict(rows, orient="index").rename_axis("experiment_id")
+
+def simulate_directory(out_dir: str = "."):
+    # Estimates the runtime of every protocol written by CodeA.main, main_parallel or main_cached in out_dir.
+    manifest_path = os.path.join(out_dir, CodeA.MANIFEST_FILE)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            files = {experiment_id: e["file"] for experiment_id, e in json.load(f)["experiments"].items()}
+    else:
+        files = {}
+        for path in glob.glob(os.path.join(out_dir, "serial_dilution_*_exp_*.py")):
+            files[re.search(r"_exp_(\w+)\.py$", path).group(1)] = os.path.basename(path)
+
+    summaries = {} # Experiments which share a protocol file are only simulated once.
+    rows = {}
+    for experiment_id, filename in files.items():
+        if filename not in summaries:
+            summaries[filename] = simulate_protocol(os.path.join(out_dir, filename))
+        rows[experiment_id] = _row(summaries[filename])
+    table = pd.DataFrame.from_dict(rows, orient="index").rename_axis("experiment_id")
+    return table.sort_index(key=lambda ids: pd.to_numeric(ids, errors="coerce"))
+
+def add_runtime_column(design_csv: str = CodeA.DESIGN_CSV, out_csv: str = None):
+    # Writes a copy of the JMP table with the predicted runtime (s) of each row as a new response column.
+    design = pd.read_csv(design_csv, dtype=str, keep_default_na=False)
+    runtimes = simulate_table(CodeA.load_design(design_csv))
+    design["Predicted_Runtime"] = runtimes["Predicted_Runtime"].round(1).to_numpy()
+    out_csv = out_csv or os.path.splitext(design_csv)[0] + "_runtime.csv"
+    design.to_csv(out_csv, index=False)
+    print(f"Wrote {out_csv}")
+    return design
@@ -0,0 +1,71 @@
+# Collector for the timing logs written on the robot by instrumented protocols (CodeA.make_protocol_code with instrument=True).
+# Each run writes TIMING_DIR/timing_<experiment id>_<start time>.log: a '# <experiment id> <start unix time>' line, then one
+# 'phase,step,start,duration' line (seconds) per pipette step. Copy the logs off the robot (e.g. scp root@<robot ip>:/data/user_storage/timings/*.log .)
+# and this module turns them into measured runtime columns per experiment and per phase, next to the predictions of CodeB_simulator.
+
+import glob
+import json
+import os
+
+import pandas as pd
+
+import CodeA
+from CodeB_simulator import PHASES
+
+
+def read_timing_log(path: str): # Returns the experiment id in the log, its start time and a table of its steps.
+    with open(path) as f:
+        _, experiment_id, started = f.readline().split()
+        steps = pd.read_csv(f, names=["phase", "step", "start", "duration"])
+    return experiment_id, float(started), steps
+
+
+def summarise(steps: pd.DataFrame):
+    # Measured runtime from the start of the first step to the end of the last, and the time spent in the steps of each phase.
+    row = {"Measured_Runtime": (steps["start"] + steps["duration"]).max() - steps["start"].min() if len(steps) else 0.0}
+    phases = steps.groupby("phase")["duration"].sum()
+    row.update({f"Measured_{phase}": float(phases.get(phase, 0.0)) for phase in PHASES})
+    row["Measured_Steps"] = len(steps)
+    return row
+
+
+def collect_timings(log_dir: str = ".", manifest_path: str = None):
+    # One row of measured times per experiment id. With main_cached, protocols are named by the hash of their parameters, and
+    # experiments which share a protocol share its id in the logs. The manifest maps them back to experiment ids: the runs of a
+    # shared protocol are given to its experiments in id order, in the order the runs were started. If an experiment was run
+    # more than once, the latest run is kept.
+    runs = sorted((read_timing_log(path) for path in glob.glob(os.path.join(log_dir, "timing_*.log"))), key=lambda run: run[1])
+
+    shared = {}
+    if manifest_path:
+        with open(manifest_path) as f:
+            for experiment_id, e in json.load(f)["experiments"].items():
+                shared.setdefault(e["hash"][:12], []).append(experiment_id)
+        shared = {h: sorted(ids, key=int) for h, ids in shared.items()}
+
+    rows = {}
+    seen = {}
+    for log_id, started, steps in runs:
+        experiment_id = log_id
+        if log_id in shared:
+            ids = shared[log_id]
+            experiment_id = ids[min(seen.get(log_id, 0), len(ids) - 1)]
+            seen[log_id] = seen.get(log_id, 0) + 1
+        rows[experiment_id] = dict(summarise(steps), Started=pd.Timestamp(started, unit="s"))
+
+    table = pd.DataFrame.from_dict(rows, orient="index").rename_axis("experiment_id")
+    return table.sort_index(key=lambda ids: pd.to_numeric(ids, errors="coerce"))
+
+
+def add_timing_columns(design_csv: str = CodeA.DESIGN_CSV, log_dir: str = ".", manifest_path: str = None, out_csv: str = None):
+    # Writes a copy of the JMP table with the measured runtime and phase times (s) of each row as new response columns.
+    # Rows which have no timing log yet are left blank.
+    design = pd.read_csv(design_csv, dtype=str, keep_default_na=False)
+    timings = collect_timings(log_dir, manifest_path)
+    ids = [str(i) for i in range(1, len(design) + 1)]
+    for c in timings.columns.drop("Started", errors="ignore"):
+        design[c] = timings[c].reindex(ids).round(1).to_numpy()
+    out_csv = out_csv or os.path.splitext(design_csv)[0] + "_timing.csv"
+    design.to_csv(out_csv, index=False)
+    print(f"Wrote {out_csv} ({len(timings)} experiments with timing logs)")
+    return design
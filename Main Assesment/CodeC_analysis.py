@@ -0,0 +1,134 @@
+# Code C analysis of whole campaigns, in place of the notebooks.
+# Finds every campaign in the data directory (pb1.xlsx, bb1.xlsx, ... for any prefix, and pb1a.xlsx, ... for absorbance),
+# reads the new or changed plate files of all campaigns across a pool of processes, and then calculates the fluorescence
+# gradient and R2 and the absorbance CV of each experiment as in CodeC_pb.ipynb, CodeC_bb.ipynb and CodeC_absorbance.ipynb.
+# The results of each campaign are written to one file, <prefix>_analysis.csv, with one row per experiment. The results of each
+# assay, which let the next run only analyse new or changed plates, are kept with the plate cache (<cache>/results).
+#
+#   python CodeC_analysis.py --data Data                 # every campaign in Data
+#   python CodeC_analysis.py --data Data --campaigns pb bb --workers 8 --n-boot 0
+#   python CodeC_analysis.py --data Data --campaigns mx --plate-map serial_dilution_BB_plate_map.csv   # one experiment per plate row
+
+import argparse
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+import CodeC_incremental
+import CodeC_ingest
+
+ASSAYS = {"": "fluorescence", "a": "absorbance"} # File suffix of each assay.
+
+
+def find_campaigns(data_dir: str = CodeC_incremental.DATA_DIR):
+    # Returns {prefix: [(suffix, assay), ...]} for the plate files in data_dir.
+    campaigns = {}
+    pattern = re.compile(r"^([A-Za-z_]+)\d+(a?)\.xlsx$")
+    for name in sorted(os.listdir(data_dir)):
+        match = pattern.match(name)
+        if match:
+            prefix, suffix = match.groups()
+            assays = campaigns.setdefault(prefix, [])
+            if (suffix, ASSAYS[suffix]) not in assays:
+                assays.append((suffix, ASSAYS[suffix]))
+    return {prefix: sorted(assays) for prefix, assays in campaigns.items()}
+
+
+def analysis_path(prefix: str, results_dir: str = CodeC_incremental.RESULTS_DIR):
+    return os.path.join(results_dir, f"{prefix}_analysis.csv")
+
+
+def state_dir(cache_dir: str = CodeC_ingest.CACHE_DIR): # Where the results of each assay are kept between runs.
+    return os.path.join(cache_dir, "results")
+
+
+def join_assays(prefix: str, assays: list, results_dir: str = CodeC_incremental.RESULTS_DIR):
+    # Joins the results files of each assay of a campaign (CodeC_incremental.update) into one table, one row per experiment.
+    table = None
+    for suffix, assay in assays:
+        results = CodeC_incremental.read_results(CodeC_incremental.results_path(prefix, suffix, results_dir))
+        if not len(results):
+            continue
+        results = results.drop(columns=["File", "Hash"]).set_index("Experiment Number")
+        table = results if table is None else table.join(results[[c for c in results.columns if c not in table.columns]], how="outer")
+    if table is None:
+        return pd.DataFrame()
+    return table.sort_index().reset_index()
+
+
+def consolidate(prefix: str, assays: list, results_dir: str = CodeC_incremental.RESULTS_DIR, cache_dir: str = CodeC_ingest.CACHE_DIR):
+    # Joins the results of each assay of a campaign and writes them to <prefix>_analysis.csv.
+    table = join_assays(prefix, assays, state_dir(cache_dir))
+    if len(table):
+        os.makedirs(results_dir, exist_ok=True)
+        table.to_csv(analysis_path(prefix, results_dir), index=False)
+    return table
+
+
+def campaign_results(prefix: str, results_dir: str = CodeC_incremental.RESULTS_DIR):
+    # The Code C results of a campaign, one row per experiment: <prefix>_analysis.csv if this module wrote it, otherwise the
+    # results files of CodeC_incremental (<prefix>_results.csv and <prefix>a_results.csv) joined.
+    path = analysis_path(prefix, results_dir)
+    if os.path.exists(path):
+        return pd.read_csv(path, dtype={"Row": str})
+    return join_assays(prefix, sorted(ASSAYS.items()), results_dir)
+
+
+def _update(job): # Worker for analyse: analyses the new or changed plates of one assay of one campaign in a separate process.
+    prefix, suffix, assay, data_dir, cache_dir, n_boot, plate_map = job
+    CodeC_incremental.update(prefix, suffix, assay, data_dir, state_dir(cache_dir), cache_dir, n_boot, plate_map)
+
+
+def analyse(prefixes: list = None, data_dir: str = CodeC_incremental.DATA_DIR, results_dir: str = CodeC_incremental.RESULTS_DIR,
+            cache_dir: str = CodeC_ingest.CACHE_DIR, workers: int = None, n_boot: int = CodeC_incremental.N_BOOT, plate_map: str = None):
+    # Analyses the campaigns in prefixes (all campaigns in data_dir if None). Returns {prefix: consolidated results}.
+    # plate_map is the plate map of a row-multiplexed campaign (CodeA.main_multiplex), which must then be the only campaign.
+    t0 = time.perf_counter()
+    campaigns = find_campaigns(data_dir)
+    if prefixes:
+        missing = [p for p in prefixes if p not in campaigns]
+        if missing:
+            raise ValueError(f"No plate files found in {data_dir} for {', '.join(missing)}")
+        campaigns = {p: campaigns[p] for p in prefixes}
+    if plate_map:
+        if len(campaigns) != 1:
+            raise ValueError("A plate map belongs to one campaign: choose it with --campaigns")
+        plate_map = pd.read_csv(plate_map, dtype={"Row": str})
+
+    # All plate files of all campaigns are read in one pool, so the processes stay busy however the plates are split.
+    paths = [path for prefix, assays in campaigns.items() for suffix, assay in assays
+             for path in CodeC_ingest.campaign_files(data_dir, prefix, suffix).values()]
+    read = CodeC_ingest.prefetch(paths, cache_dir, workers=workers)
+    print(f"Read {read} of {len(paths)} plate files from Excel ({time.perf_counter() - t0:.1f} s)")
+
+    # The fits (with their bootstrap) of each assay of each campaign are then made in a second pool. Every plate is in the cache
+    # by now, so the workers only load arrays from it.
+    jobs = [(prefix, suffix, assay, data_dir, cache_dir, n_boot, plate_map) for prefix, assays in campaigns.items() for suffix, assay in assays]
+    os.makedirs(state_dir(cache_dir), exist_ok=True)
+    with ProcessPoolExecutor(max_workers=min(workers or os.cpu_count() or 1, max(len(jobs), 1))) as pool:
+        list(pool.map(_update, jobs))
+    print(f"Analysed {len(jobs)} assays ({time.perf_counter() - t0:.1f} s)")
+
+    tables = {}
+    for prefix, assays in campaigns.items():
+        tables[prefix] = consolidate(prefix, assays, results_dir, cache_dir)
+        print(f"Wrote {analysis_path(prefix, results_dir)} ({len(tables[prefix])} experiments)")
+    print(f"Finished in {time.perf_counter() - t0:.1f} s")
+    return tables
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Analyse plate reader files of one or more campaigns.")
+    parser.add_argument("--data", default=CodeC_incremental.DATA_DIR, help="directory of the plate reader .xlsx files")
+    parser.add_argument("--campaigns", nargs="+", help="file prefixes to analyse, e.g. pb bb (default: all)")
+    parser.add_argument("--results", default=CodeC_incremental.RESULTS_DIR, help="directory for the <prefix>_analysis.csv files")
+    parser.add_argument("--cache", default=CodeC_ingest.CACHE_DIR, help="plate cache directory")
+    parser.add_argument("--workers", type=int, default=None, help="processes for reading and fitting plate files (default: all cores)")
+    parser.add_argument("--n-boot", type=int, default=CodeC_incremental.N_BOOT, help="bootstrap resamples, 0 to skip")
+    parser.add_argument("--plate-map", help="plate map of a row-multiplexed campaign, written by CodeA.main_multiplex")
+    args = parser.parse_args()
+
+    analyse(args.campaigns, args.data, args.results, args.cache, args.workers, args.n_boot, args.plate_map)
@@ -0,0 +1,78 @@
+# Log-log dilution curve fitting for Code C.
+# Fits the gradient, intercept and R2 of log10(measured) against log10(theoretical concentration) for every experiment at once,
+# as in CodeC_pb.ipynb and CodeC_bb.ipynb, and uses the 8 rows of each plate as replicates to bootstrap confidence intervals.
+# Plates are arrays of shape (experiments, 8, 11), e.g. CodeC_ingest.load_plates(paths)[0][:, 0].
+
+import numpy as np
+import pandas as pd
+
+FLUOR_CONC = 10 / 2 ** np.arange(11)   # Theoretical fluorescein concentration of plate columns 1-11.
+N_BOOT = 2000                          # Number of bootstrap resamples.
+BOOT_CHUNK = 64                        # Experiments resampled at a time, which bounds memory to about BOOT_CHUNK * N_BOOT * 11 values.
+
+
+def fit_lines(x: np.ndarray, y: np.ndarray):
+    # Least squares fit of y = m * x + b over the last axis of y, for any number of leading axes (experiments, resamples, ...).
+    # Returns slope, intercept and R2 with the leading shape of y. Same result as np.polyfit(x, y, 1) for each line.
+    x = np.asarray(x, dtype=float)
+    dx = x - x.mean()
+    sxx = np.sum(dx ** 2)
+    y_mean = y.mean(axis=-1)
+    dy = y - y_mean[..., None]
+    sxy = dy @ dx
+    syy = np.sum(dy ** 2, axis=-1)
+    slope = sxy / sxx
+    intercept = y_mean - slope * x.mean()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        r2 = sxy ** 2 / (sxx * syy) # 1 - ss_res / ss_tot for a straight line fit.
+    return slope, intercept, r2
+
+
+def fit_experiments(plates: np.ndarray, conc: np.ndarray = FLUOR_CONC):
+    # Gradient, intercept and R2 of the column means of each plate, as calculated in the notebooks.
+    with np.errstate(divide="ignore", invalid="ignore"):
+        y = np.log10(np.mean(plates, axis=-2))
+    return fit_lines(np.log10(conc), y)
+
+
+def fit_rows(plates: np.ndarray, conc: np.ndarray = FLUOR_CONC):
+    # Gradient, intercept and R2 of each row of each plate, for plates whose rows hold different experiments (CodeA.main_multiplex).
+    with np.errstate(divide="ignore", invalid="ignore"):
+        y = np.log10(plates)
+    return fit_lines(np.log10(conc), y)
+
+
+def bootstrap(plates: np.ndarray, conc: np.ndarray = FLUOR_CONC, n_boot: int = N_BOOT, ci: float = 0.95, seed: int = 0):
+    # Bootstrap confidence intervals of the gradient and R2 of each experiment. Each resample draws the 8 plate rows with
+    # replacement, keeping each row's whole dilution series together as it was made by one channel of the pipette.
+    # A resample is a weighted mean of the rows, so all resamples of a chunk of experiments are one matrix product.
+    plates = np.asarray(plates, dtype=float)
+    n_exp, n_rows = plates.shape[0], plates.shape[-2]
+    rng = np.random.default_rng(seed)
+    weights = rng.multinomial(n_rows, np.full(n_rows, 1 / n_rows), size=n_boot) / n_rows   # (n_boot, rows)
+    x = np.log10(conc)
+    q = [50 * (1 - ci), 50 * (1 + ci)]
+
+    out = {k: np.empty(n_exp) for k in ["Gradient_CI_Low", "Gradient_CI_High", "Gradient_SE", "R2_CI_Low", "R2_CI_High"]}
+    for start in range(0, n_exp, BOOT_CHUNK):
+        chunk = slice(start, start + BOOT_CHUNK)
+        means = np.einsum("br,erc->ebc", weights, plates[chunk])                            # (experiments, n_boot, 11)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            slope, intercept, r2 = fit_lines(x, np.log10(means))
+        out["Gradient_CI_Low"][chunk], out["Gradient_CI_High"][chunk] = np.nanpercentile(slope, q, axis=1)
+        out["Gradient_SE"][chunk] = np.nanstd(slope, axis=1, ddof=1)
+        out["R2_CI_Low"][chunk], out["R2_CI_High"][chunk] = np.nanpercentile(r2, q, axis=1)
+    return out
+
+
+def gradient_table(plates: np.ndarray, experiment_numbers=None, conc: np.ndarray = FLUOR_CONC, n_boot: int = N_BOOT, ci: float = 0.95, seed: int = 0):
+    # The notebooks' gradient table (Experiment Number, Gradient, R2) with the intercept and bootstrap intervals added.
+    # Use n_boot=0 to skip the bootstrap.
+    slope, intercept, r2 = fit_experiments(plates, conc)
+    if experiment_numbers is None:
+        experiment_numbers = np.arange(1, len(slope) + 1)
+    table = pd.DataFrame({"Experiment Number": experiment_numbers, "Gradient": slope, "Intercept": intercept, "R2": r2})
+    if n_boot:
+        for k, v in bootstrap(plates, conc, n_boot, ci, seed).items():
+            table[k] = v
+    return table
@@ -0,0 +1,177 @@
+# Incremental Code C analysis.
+# Finds the plate files of each campaign in the data directory and only analyses plates which are new or have changed since
+# the last run. Results are appended to a results file per campaign (e.g. pb_results.csv), so each run costs O(new plates)
+# and the results can be updated as plates come off the reader.
+
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+import CodeC_fit
+import CodeC_ingest
+
+DATA_DIR = "Data"           # change this for your data file path
+RESULTS_DIR = "."
+N_BOOT = 1000               # Bootstrap resamples for the gradient and R2 intervals. 0 skips the bootstrap.
+PLATE_ROWS = "ABCDEFGH"
+ABSORBANCE_WAVELENGTHS = (900, 975)  # nm, the reference and the measurement blocks of an absorbance plate.
+
+# (file prefix, file suffix, assay) of each campaign. Fluorescence files are e.g. pb1.xlsx, absorbance files are e.g. pb1a.xlsx.
+CAMPAIGNS = [("pb", "", "fluorescence"), ("bb", "", "fluorescence"), ("pb", "a", "absorbance"), ("bb", "a", "absorbance")]
+
+
+class RunningStats:
+    # Running count, mean and sum of squared differences from the mean of each experiment (Welford's method), updated with a
+    # batch of values at a time by combining the batch's own mean and sum of squares (Chan et al.). One instance follows a whole
+    # campaign: only these three numbers are kept per experiment, so each plate can be released once it has been added. As with
+    # np.mean and np.std in the notebooks, an experiment with an empty (NaN) well gives NaN.
+    def __init__(self):
+        self.n, self.mean, self.m2 = {}, {}, {}
+
+    def add(self, key, values: np.ndarray):
+        values = np.asarray(values, dtype=float).ravel()
+        mean = values.mean()
+        m2 = np.sum((values - mean) ** 2)
+        n = self.n.get(key, 0)
+        if n: # Chan et al.: merge the batch into the values seen so far.
+            delta = mean - self.mean[key]
+            total = n + values.size
+            self.m2[key] += m2 + delta ** 2 * n * values.size / total
+            self.mean[key] += delta * values.size / total
+        else:
+            self.m2[key], self.mean[key] = m2, mean
+        self.n[key] = n + values.size
+        return self
+
+    def std(self, key): # Sample standard deviation (ddof=1), as np.std(..., ddof=1) in the notebooks.
+        return np.sqrt(self.m2[key] / (self.n[key] - 1)) if self.n[key] > 1 else np.nan
+
+
+# The metrics take plates as any iterable of (blocks, labels), as returned by CodeC_ingest.read_plate_cached, e.g. a generator
+# reading one file at a time.
+
+def _absorbance_difference(blocks: np.ndarray, labels: list): # The 975 nm - 900 nm difference of each well of one plate.
+    reference, measurement = CodeC_ingest.select_blocks(blocks, labels, ABSORBANCE_WAVELENGTHS)
+    return measurement - reference
+
+
+def fluorescence_metrics(plates, numbers: list, n_boot: int = N_BOOT):
+    # Gradient and R2 of the log-log dilution curve, from the first block of each plate. The fits are made for all plates at once.
+    first = np.stack([blocks[0] for blocks, labels in plates])
+    return CodeC_fit.gradient_table(first, numbers, n_boot=n_boot)
+
+
+def absorbance_metrics(plates, numbers: list, n_boot: int = N_BOOT):
+    # Average, Stdev and CV of the 975 nm - 900 nm difference over all wells of each plate (Method 1 of CodeC_absorbance.ipynb).
+    # Each plate is subtracted, added to the running statistics of its experiment and released, so memory does not grow with
+    # the number of plates. A plate with an empty well gives NaN.
+    stats = RunningStats()
+    for number, (blocks, labels) in zip(numbers, plates):
+        stats.add(number, _absorbance_difference(blocks, labels))
+    table = pd.DataFrame({"Experiment Number": numbers, "Average": [stats.mean[k] for k in numbers], "Stdev": [stats.std(k) for k in numbers]})
+    table["CV"] = table["Stdev"] / table["Average"]
+    return table
+
+
+METRICS = {"fluorescence": fluorescence_metrics, "absorbance": absorbance_metrics}
+
+
+# Row-multiplexed plates (CodeA.main_multiplex) hold a different experiment in each row. The plate map gives the experiment of each
+# (Plate, Row), and the metrics are calculated for each row on its own. A row has no replicates, so there is no bootstrap.
+
+def _by_row(numbers: list, metrics: dict, plate_map: pd.DataFrame):
+    # One row per experiment in the plate map: Experiment Number, Plate, Row and the metrics of its plate row.
+    rows = pd.DataFrame({"Plate": np.repeat(numbers, len(PLATE_ROWS)), "Row": np.tile(list(PLATE_ROWS), len(numbers))})
+    for k, v in metrics.items():
+        rows[k] = np.ravel(v)
+    return plate_map[["Experiment Number", "Plate", "Row"]].merge(rows, on=["Plate", "Row"])
+
+
+def fluorescence_row_metrics(plates, numbers: list, plate_map: pd.DataFrame):
+    first = np.stack([blocks[0] for blocks, labels in plates])
+    slope, intercept, r2 = CodeC_fit.fit_rows(first)
+    return _by_row(numbers, {"Gradient": slope, "Intercept": intercept, "R2": r2}, plate_map)
+
+
+def absorbance_row_metrics(plates, numbers: list, plate_map: pd.DataFrame):
+    # Average, Stdev and CV of the 975 nm - 900 nm difference over the 11 wells of each row, streamed through RunningStats as in
+    # absorbance_metrics. A row with an empty well gives NaN.
+    stats = RunningStats()
+    for number, (blocks, labels) in zip(numbers, plates):
+        for row, values in zip(PLATE_ROWS, _absorbance_difference(blocks, labels)):
+            stats.add((number, row), values)
+    mean = np.array([[stats.mean[number, row] for row in PLATE_ROWS] for number in numbers])
+    std = np.array([[stats.std((number, row)) for row in PLATE_ROWS] for number in numbers])
+    return _by_row(numbers, {"Average": mean, "Stdev": std, "CV": std / mean}, plate_map)
+
+
+ROW_METRICS = {"fluorescence": fluorescence_row_metrics, "absorbance": absorbance_row_metrics}
+
+
+def results_path(prefix: str, suffix: str = "", results_dir: str = RESULTS_DIR):
+    return os.path.join(results_dir, f"{prefix}{suffix}_results.csv")
+
+
+def read_results(path: str): # The latest result of each experiment in a results file.
+    if not os.path.exists(path):
+        return pd.DataFrame()
+    results = pd.read_csv(path, dtype={"File": str, "Hash": str})
+    return results.drop_duplicates("Experiment Number", keep="last").sort_values("Experiment Number").reset_index(drop=True)
+
+
+def update(prefix: str, suffix: str = "", assay: str = "fluorescence", data_dir: str = DATA_DIR, results_dir: str = RESULTS_DIR,
+           cache_dir: str = CodeC_ingest.CACHE_DIR, n_boot: int = N_BOOT, plate_map: pd.DataFrame = None):
+    # Analyses the new or changed plates of one campaign and adds them to its results file. Returns the campaign's results.
+    # For row-multiplexed plates, give the plate map written by CodeA.main_multiplex (plate files are numbered by plate) and
+    # each row is analysed as its own experiment.
+    path = results_path(prefix, suffix, results_dir)
+    results = read_results(path)
+    known = dict(zip(results["File"], results["Hash"])) if len(results) else {}
+
+    index = CodeC_ingest.load_index(cache_dir)
+    todo = []
+    for number, plate_path in CodeC_ingest.campaign_files(data_dir, prefix, suffix).items():
+        h = CodeC_ingest.fingerprint(plate_path, index)
+        if known.get(os.path.basename(plate_path)) != h:
+            todo.append((number, plate_path, h))
+
+    if todo:
+        plates = (CodeC_ingest.read_plate_cached(plate_path, cache_dir, index) for number, plate_path, h in todo) # Read as the metrics need them.
+        numbers = [number for number, plate_path, h in todo]
+        if plate_map is None:
+            new = METRICS[assay](plates, numbers, n_boot)
+            files = new["Experiment Number"]
+        else:
+            new = ROW_METRICS[assay](plates, numbers, plate_map)
+            files = new["Plate"]
+        source = {number: (os.path.basename(plate_path), h) for number, plate_path, h in todo}
+        new.insert(1, "File", [source[number][0] for number in files])
+        new.insert(2, "Hash", [source[number][1] for number in files])
+
+        changed = any(os.path.basename(plate_path) in known for number, plate_path, h in todo)
+        os.makedirs(results_dir, exist_ok=True)
+        if changed: # A re-read plate replaces its old row, so the file is rewritten once without the old rows.
+            pd.concat([results, new]).drop_duplicates("Experiment Number", keep="last").to_csv(path, index=False)
+        else:       # New plates are appended without rewriting the existing results.
+            new.to_csv(path, mode="a", header=not os.path.exists(path), index=False)
+    CodeC_ingest.save_index(cache_dir, index)
+
+    print(f"{prefix}{suffix}: analysed {len(todo)} new or changed plates")
+    return read_results(path)
+
+
+def update_all(campaigns: list = CAMPAIGNS, **kwargs):
+    return {f"{prefix}{suffix}": update(prefix, suffix, assay, **kwargs) for prefix, suffix, assay in campaigns}
+
+
+def watch(campaigns: list = CAMPAIGNS, interval: float = 30, **kwargs):
+    # Checks the data directory every interval seconds and analyses plates as they are exported from the plate reader. Stop with Ctrl+C.
+    while True:
+        update_all(campaigns, **kwargs)
+        time.sleep(interval)
+
+
+if __name__ == "__main__":
+    update_all()
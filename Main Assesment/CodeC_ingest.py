@@ -0,0 +1,205 @@
+# Plate reader ingestion for Code C.
+# Reads each FLUOstar workbook once, in read-only mode, and finds every plate block on the 'End point' sheet from its header
+# row (1, 2, 3, ... across the columns) instead of fixed skiprows. Absorbance workbooks have two blocks (900 nm then 975 nm),
+# fluorescence workbooks have one. A campaign is returned as one array of shape (experiments, blocks, 8, 11) and cached as a
+# .npy file, so re-analysis opens it with np.load(mmap_mode="r") and skips Excel completely.
+
+import hashlib
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from openpyxl import load_workbook
+
+SHEET_NAME = "End point"
+PLATE_ROWS = 8          # Rows A-H.
+PLATE_COLS = 11         # Columns 1-11 hold the dilution series. Column 12 is not used.
+CACHE_DIR = ".plate_cache"
+
+
+def _number(value):
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(str(value).strip())
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _is_header(row: tuple): # A block header has the plate column numbers 1, 2, 3, ... from column B onwards.
+    return len(row) > PLATE_COLS and [_number(v) for v in row[1:4]] == [1.0, 2.0, 3.0]
+
+
+def read_plate_blocks(path: str):
+    # Returns an array of shape (blocks, 8, 11) and the label above each block (e.g. 'Raw Data (900)'), or '' if there is none.
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        blocks, labels = [], []
+        label = ""
+        rows_left = 0
+        for row in workbook[SHEET_NAME].iter_rows(values_only=True):
+            if rows_left:
+                blocks[-1].append([_number(v) for v in row[1:PLATE_COLS + 1]])
+                rows_left -= 1
+            elif _is_header(row):
+                blocks.append([])
+                labels.append(label)
+                rows_left = PLATE_ROWS
+            else:
+                text = [str(v) for v in row if isinstance(v, str) and v.strip()]
+                if text:
+                    label = text[0].strip()
+    finally:
+        workbook.close()
+
+    if not blocks:
+        raise ValueError(f"No plate blocks found on the '{SHEET_NAME}' sheet of {path}")
+    return np.array(blocks, dtype=float), labels
+
+
+def wavelength(label: str): # The wavelength in a block label, e.g. 'Raw Data (975)' -> 975. None if the label has no wavelength.
+    match = re.search(r"\b(\d{3})\b", label)
+    return int(match.group(1)) if match else None
+
+
+def select_blocks(blocks: np.ndarray, labels: list, wavelengths: list):
+    # The blocks read at each of wavelengths, in that order, found by the wavelength in their labels. e.g. (900, 975) gives the
+    # 900 nm and 975 nm blocks of an absorbance plate whichever order the reader wrote them in.
+    found = [wavelength(label) for label in labels]
+    missing = [str(w) for w in wavelengths if w not in found]
+    if missing:
+        raise ValueError(f"No {' or '.join(missing)} nm block among the plate blocks {labels}")
+    return blocks[[found.index(w) for w in wavelengths]]
+
+
+def campaign_files(data_dir: str, prefix: str, suffix: str = ""):
+    # Finds the plate files of a campaign, e.g. prefix 'pb' finds pb1.xlsx, pb2.xlsx, ... and suffix 'a' finds pb1a.xlsx, ...
+    # Returns {experiment number: path} in experiment order.
+    pattern = re.compile(rf"^{re.escape(prefix)}(\d+){re.escape(suffix)}\.xlsx$")
+    files = {}
+    for name in os.listdir(data_dir):
+        match = pattern.match(name)
+        if match:
+            files[int(match.group(1))] = os.path.join(data_dir, name)
+    return dict(sorted(files.items()))
+
+
+def file_hash(path: str):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def load_index(cache_dir: str):
+    path = os.path.join(cache_dir, "index.json")
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+
+def save_index(cache_dir: str, index: dict):
+    path = os.path.join(cache_dir, "index.json")
+    tmp_path = f"{path}.{os.getpid()}.tmp" # One temporary file per process, so processes saving at the same time do not collide.
+    with open(tmp_path, "w") as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def fingerprint(path: str, index: dict):
+    # Returns the content hash of a plate file. The hash is only recomputed when the file's mtime or size has changed.
+    stat = os.stat(path)
+    files = index.setdefault("files", {})
+    entry = files.get(os.path.abspath(path))
+    if entry and entry["mtime_ns"] == stat.st_mtime_ns and entry["size"] == stat.st_size:
+        return entry["hash"]
+    h = file_hash(path)
+    files[os.path.abspath(path)] = {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "hash": h}
+    return h
+
+
+def read_plate_cached(path: str, cache_dir: str = CACHE_DIR, index: dict = None):
+    # read_plate_blocks with a cache of each file's blocks, keyed by the file's content hash.
+    os.makedirs(cache_dir, exist_ok=True)
+    save = index is None
+    index = load_index(cache_dir) if index is None else index
+    h = fingerprint(path, index)
+    npy = os.path.join(cache_dir, f"{h}.npy")
+    if os.path.exists(npy) and h in index.get("labels", {}):
+        blocks, labels = np.load(npy), index["labels"][h]
+    else:
+        blocks, labels = read_plate_blocks(path)
+        np.save(npy, blocks)
+        index.setdefault("labels", {})[h] = labels
+    if save:
+        save_index(cache_dir, index)
+    return blocks, labels
+
+
+def prefetch(paths: list, cache_dir: str = CACHE_DIR, index: dict = None, workers: int = None):
+    # Reads the files in paths which are not cached yet across a pool of processes and adds them to the cache, so that later
+    # calls of read_plate_cached and load_plates do not open Excel. Returns the number of files read.
+    os.makedirs(cache_dir, exist_ok=True)
+    save = index is None
+    index = load_index(cache_dir) if index is None else index
+    todo = {}
+    for path in paths:
+        h = fingerprint(path, index)
+        if not (os.path.exists(os.path.join(cache_dir, f"{h}.npy")) and h in index.get("labels", {})):
+            todo.setdefault(h, path) # Identical files are only read once.
+
+    if todo:
+        workers = min(workers or os.cpu_count() or 1, len(todo))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            chunksize = max(1, len(todo) // (4 * workers))
+            for h, (blocks, labels) in zip(todo, pool.map(read_plate_blocks, todo.values(), chunksize=chunksize)):
+                np.save(os.path.join(cache_dir, f"{h}.npy"), blocks)
+                index.setdefault("labels", {})[h] = labels
+    if save:
+        save_index(cache_dir, index)
+    return len(todo)
+
+
+def _remove_superseded(cache_dir: str, index: dict, key: str, paths: list):
+    # Deletes the campaign arrays made earlier from any of the same files (e.g. before a plate was added or re-exported), so the
+    # cache keeps one array per campaign. Arrays of other campaigns in the same cache directory are kept.
+    sources = index.setdefault("campaign_files", {})
+    files = [os.path.abspath(p) for p in paths]
+    for old, old_files in list(sources.items()):
+        if old != key and not set(old_files).isdisjoint(files):
+            try:
+                os.remove(os.path.join(cache_dir, f"campaign_{old}.npy"))
+            except FileNotFoundError:
+                pass
+            except OSError: # Still memory-mapped by another process (Windows). It is removed by a later call.
+                continue
+            index["campaigns"].pop(old, None)
+            del sources[old]
+    sources[key] = files
+
+
+def load_plates(paths: list, cache_dir: str = CACHE_DIR):
+    # Returns a read-only memory-mapped array of shape (experiments, blocks, 8, 11) for the plate files in paths, and the block labels.
+    # Files with fewer blocks than the others are padded with NaN. Only new or changed files are read from Excel.
+    os.makedirs(cache_dir, exist_ok=True)
+    index = load_index(cache_dir)
+    hashes = [fingerprint(p, index) for p in paths]
+    key = hashlib.sha256("".join(hashes).encode()).hexdigest()[:16]
+    campaign = os.path.join(cache_dir, f"campaign_{key}.npy")
+
+    if not (os.path.exists(campaign) and key in index.get("campaigns", {})):
+        plates = [read_plate_cached(p, cache_dir, index) for p in paths]
+        n_blocks = max(blocks.shape[0] for blocks, labels in plates)
+        stacked = np.full((len(paths), n_blocks, PLATE_ROWS, PLATE_COLS), np.nan)
+        for i, (blocks, labels) in enumerate(plates):
+            stacked[i, :blocks.shape[0]] = blocks
+        np.save(campaign, stacked)
+        index.setdefault("campaigns", {})[key] = max((labels for blocks, labels in plates), key=len)
+        _remove_superseded(cache_dir, index, key, paths)
+    save_index(cache_dir, index)
+
+    return np.load(campaign, mmap_mode="r"), index["campaigns"][key]
@@ -0,0 +1,170 @@
+# Effect estimation and response models for the Code C results, in place of the JMP round trip of step 5.
+# Joins the resolved design with the Code C results (as CodeA_optimizer.load_history), codes each factor varied in the design to
+# -1 .. +1, and fits the Gradient, R2 and CV with one least squares solve. Models are main effects (Plackett-Burman and other
+# screening designs), main effects with two-factor interactions (full factorials) or a full quadratic response surface. Effects
+# are reported as in JMP's Sorted Parameter Estimates, and the fitted models give the settings with the highest desirability.
+#
+#   effects, best = analyse("pb_design.csv", "pb")
+
+import math
+
+import numpy as np
+import pandas as pd
+
+import CodeA
+import CodeA_optimizer
+import CodeC_incremental
+
+RESPONSES = ["Gradient", "R2", "CV"]
+N_SEARCH = 20000   # Random settings scored when searching for the highest desirability.
+
+
+def _coded(x: np.ndarray, bounds: dict): # Factor values scaled so the low and high levels of the design are -1 and +1.
+    lo, hi = np.array(list(bounds.values())).T
+    return 2 * (x - lo) / (hi - lo) - 1
+
+
+def model_terms(factors: list, model: str = "interactions", levels: dict = None):
+    # The terms of a model as tuples of factor indices: () is the intercept, (i,) a main effect, (i, j) an interaction and (i, i)
+    # a quadratic term. Quadratic terms are only added for factors with more than two levels in the design.
+    terms = [()] + [(i,) for i in range(len(factors))]
+    if model in ("interactions", "quadratic"):
+        terms += [(i, j) for i in range(len(factors)) for j in range(i + 1, len(factors))]
+    if model == "quadratic":
+        terms += [(i, i) for i, k in enumerate(factors) if levels is None or levels[k] > 2]
+    return terms
+
+
+def term_name(term: tuple, factors: list):
+    return "Intercept" if not term else "*".join(factors[i] for i in term)
+
+
+def model_matrix(coded: np.ndarray, terms: list):
+    return np.column_stack([np.prod(coded[:, list(t)], axis=1) if t else np.ones(len(coded)) for t in terms])
+
+
+def _t_pvalue(t: np.ndarray, df: float):
+    # Two-sided p-value of Student's t, from the regularised incomplete beta function I_x(df/2, 1/2) (Numerical Recipes 6.4).
+    def betai(a, b, x):
+        if x <= 0 or x >= 1:
+            return float(x >= 1)
+        front = math.exp(math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b) + a * math.log(x) + b * math.log(1 - x))
+        if x > (a + 1) / (a + b + 2):
+            return 1 - betai(b, a, 1 - x)
+        c, d = 1.0, 1 - (a + b) * x / (a + 1)
+        d = 1 / (d if abs(d) > 1e-30 else 1e-30)
+        f = d
+        for m in range(1, 200):
+            for num in (m * (b - m) * x / ((a + 2 * m - 1) * (a + 2 * m)), -(a + m) * (a + b + m) * x / ((a + 2 * m) * (a + 2 * m + 1))):
+                d = 1 + num * d
+                d = 1 / (d if abs(d) > 1e-30 else 1e-30)
+                c = 1 + num / c
+                c = c if abs(c) > 1e-30 else 1e-30
+                f *= c * d
+            if abs(c * d - 1) < 1e-12:
+                break
+        return front * f / a
+    return np.array([betai(df / 2, 0.5, df / (df + v ** 2)) if np.isfinite(v) else np.nan for v in np.ravel(t)]).reshape(np.shape(t))
+
+
+def _lenth_pse(estimates: np.ndarray):
+    # Lenth's pseudo standard error of effect estimates, for saturated designs with no degrees of freedom left for error.
+    a = np.abs(estimates)
+    s0 = 1.5 * np.median(a)
+    return 1.5 * np.median(a[a < 2.5 * s0]) if np.any(a < 2.5 * s0) else s0
+
+
+class ResponseModel:
+    # Least squares models of several responses on the same terms of the coded factors.
+    def __init__(self, history: pd.DataFrame, bounds: dict, responses: list = RESPONSES, model: str = "auto"):
+        self.bounds = {k: v for k, v in bounds.items() if history[k].nunique() > 1} # Factors which did not vary cannot be estimated.
+        self.factors = list(self.bounds)
+        self.responses = [r for r in responses if r in history]
+        x = history[self.factors].to_numpy(dtype=float)
+        levels = {k: history[k].nunique() for k in self.factors}
+        if model == "auto": # Interactions if the design has enough runs to estimate them, otherwise main effects.
+            model = "interactions" if len(history) > len(model_terms(self.factors, "interactions")) else "main"
+        self.model = model
+        self.terms = model_terms(self.factors, model, levels)
+        X = model_matrix(_coded(x, self.bounds), self.terms)
+
+        self.coef = np.full((len(self.terms), len(self.responses)), np.nan)
+        self.se = np.full_like(self.coef, np.nan)
+        self.df = np.zeros(len(self.responses))
+        y = history[self.responses].to_numpy(dtype=float)
+        masks = {}
+        for j in range(len(self.responses)): # Responses with the same missing rows are fitted together in one solve.
+            masks.setdefault(tuple(np.isfinite(y[:, j])), []).append(j)
+        for mask, cols in masks.items():
+            rows = np.array(mask)
+            Xr, yr = X[rows], y[rows][:, cols]
+            coef, _, rank, _ = np.linalg.lstsq(Xr, yr, rcond=None)
+            self.coef[:, cols] = coef
+            df = rows.sum() - rank
+            self.df[cols] = df
+            if df > 0:
+                sigma2 = np.sum((yr - Xr @ coef) ** 2, axis=0) / df
+                self.se[:, cols] = np.sqrt(np.outer(np.diag(np.linalg.pinv(Xr.T @ Xr)), sigma2))
+
+    def predict(self, x: np.ndarray): # Predicted responses (rows, responses) at uncoded factor settings (rows, factors).
+        return model_matrix(_coded(np.atleast_2d(x), self.bounds), self.terms) @ self.coef
+
+    def effects(self):
+        # One row per response and term: Estimate (per coded unit), Effect (change from the low to the high level, 2 x Estimate),
+        # Std Error, t Ratio and Prob>|t|. Saturated fits use Lenth's pseudo standard error with (terms - 1) / 3 degrees of freedom.
+        rows = []
+        for j, response in enumerate(self.responses):
+            est = self.coef[1:, j]
+            se = self.se[1:, j]
+            df = self.df[j]
+            if df <= 0:
+                se = np.full_like(est, _lenth_pse(est))
+                df = len(est) / 3
+            t = est / se
+            p = _t_pvalue(t, df)
+            for k, term in enumerate(self.terms[1:]):
+                rows.append({"Response": response, "Term": term_name(term, self.factors), "Estimate": est[k],
+                             "Effect": 2 * est[k] if len(term) == 1 or term[0] != term[1] else est[k],
+                             "Std Error": se[k], "t Ratio": t[k], "Prob>|t|": p[k]})
+        table = pd.DataFrame(rows)
+        return table.reindex(table["t Ratio"].abs().sort_values(ascending=False).index).reset_index(drop=True)
+
+    def optimum(self, goals: dict = CodeA_optimizer.DESIRABILITY, n: int = N_SEARCH, seed: int = 0):
+        # The factor settings within the design's ranges with the highest predicted desirability, found by a random search
+        # followed by shrinking steps around the best point.
+        rng = np.random.default_rng(seed)
+        lo, hi = np.array(list(self.bounds.values())).T
+        ints = np.array([CodeA.PARAM_TYPES[k] is int for k in self.factors])
+
+        def score(x):
+            x = np.where(ints, np.round(x), x)
+            return CodeA_optimizer.desirability(pd.DataFrame(self.predict(x), columns=self.responses), goals), x
+
+        x = lo + rng.uniform(size=(n, len(lo))) * (hi - lo)
+        d, x = score(x)
+        best, best_d = x[np.argmax(d)], d.max()
+        step = 0.1
+        for _ in range(30):
+            trial = np.clip(best + step * (hi - lo) * rng.uniform(-1, 1, size=(256, len(lo))), lo, hi)
+            d, trial = score(trial)
+            if d.max() > best_d:
+                best, best_d = trial[np.argmax(d)], d.max()
+            else:
+                step /= 2
+        result = pd.Series(dict(zip(self.factors, best)))
+        for k, v in zip(self.responses, self.predict(best)[0]):
+            result[f"Predicted_{k}"] = v
+        result["Desirability"] = best_d
+        return result
+
+
+def analyse(design_csv: str, prefix: str, results_dir: str = CodeC_incremental.RESULTS_DIR, model: str = "auto"):
+    # Fits the responses of a campaign, prints the effects with Prob>|t| below 0.05 and the best settings. Returns the effects and the best settings.
+    history = CodeA_optimizer.load_history(design_csv, prefix, results_dir)
+    fitted = ResponseModel(history, CodeA_optimizer.factor_bounds(design_csv), model=model)
+    effects = fitted.effects()
+    best = fitted.optimum()
+    print(f"{len(history)} experiments, {fitted.model} model with {len(fitted.terms)} terms")
+    print(effects[effects["Prob>|t|"] < 0.05].to_string(index=False))
+    print(best.to_string())
+    return effects, best
@@ -0,0 +1,225 @@
+# Results store linking the designs, protocols, plate data and results of every campaign.
+# A single SQLite file (campaigns.db) holds the resolved parameters of each experiment, its protocol, the raw plate arrays read
+# from the plate reader files and the Code C results. Experiments are keyed by campaign and experiment id, so results never need
+# matching to JMP rows by hand, and are indexed by parameter hash, so the same parameter set can be found across campaigns.
+# Queries and exports to JMP read the store only, without opening Excel.
+#
+#   con = connect()
+#   add_campaign(con, "pb", "pb_design.csv", data_dir="Data")
+#   add_campaign(con, "mx", "mx_design.csv", data_dir="Data", plate_map="serial_dilution_BB_plate_map.csv") # main_multiplex
+#   export_jmp(con, ["pb", "bb"], "all_campaigns.csv")
+
+import io
+import json
+import os
+import sqlite3
+import time
+import zlib
+
+import numpy as np
+import pandas as pd
+
+import CodeA
+import CodeC_analysis
+import CodeC_incremental
+import CodeC_ingest
+
+STORE_PATH = "campaigns.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS campaigns (
+    campaign TEXT PRIMARY KEY,
+    design_csv TEXT,
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS experiments (
+    campaign TEXT NOT NULL,
+    experiment_id INTEGER NOT NULL,
+    params_hash TEXT NOT NULL,
+    params TEXT NOT NULL,
+    protocol_file TEXT,
+    PRIMARY KEY (campaign, experiment_id)
+);
+CREATE INDEX IF NOT EXISTS experiments_hash ON experiments (params_hash);
+CREATE TABLE IF NOT EXISTS protocols (
+    params_hash TEXT PRIMARY KEY,
+    template_version TEXT NOT NULL,
+    code BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS plates (
+    campaign TEXT NOT NULL,
+    plate INTEGER NOT NULL,
+    assay TEXT NOT NULL,
+    file TEXT NOT NULL,
+    file_hash TEXT NOT NULL,
+    labels TEXT NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (campaign, plate, assay)
+);
+CREATE INDEX IF NOT EXISTS plates_hash ON plates (file_hash);
+CREATE TABLE IF NOT EXISTS plate_rows (
+    campaign TEXT NOT NULL,
+    experiment_id INTEGER NOT NULL,
+    plate INTEGER NOT NULL,
+    row TEXT NOT NULL,
+    PRIMARY KEY (campaign, experiment_id)
+);
+CREATE TABLE IF NOT EXISTS metrics (
+    campaign TEXT NOT NULL,
+    experiment_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    value REAL,
+    PRIMARY KEY (campaign, experiment_id, name)
+);
+CREATE INDEX IF NOT EXISTS metrics_name ON metrics (name);
+"""
+
+
+def connect(path: str = STORE_PATH):
+    con = sqlite3.connect(path)
+    con.executescript(SCHEMA)
+    return con
+
+
+def _array_blob(array: np.ndarray):
+    buffer = io.BytesIO()
+    np.save(buffer, np.ascontiguousarray(array))
+    return buffer.getvalue()
+
+
+def add_design(con: sqlite3.Connection, campaign: str, design_csv: str, manifest_path: str = None, plate_map: str = None):
+    # Stores the resolved parameters and the protocol of every row of a design. Protocols are stored once per parameter hash.
+    # If the protocols were written by main_cached, its manifest gives the file each experiment ran; otherwise the file name of main.
+    # For a row-multiplexed campaign, plate_map is the plate map written by main_multiplex: the plate and row of each experiment
+    # are stored in plate_rows, and the file each experiment ran is its plate's protocol.
+    table = CodeA.load_design(design_csv)
+    files, placed = {}, []
+    if manifest_path:
+        with open(manifest_path) as f:
+            files = {experiment_id: e["file"] for experiment_id, e in json.load(f)["experiments"].items()}
+    if plate_map:
+        plate_map = pd.read_csv(plate_map, dtype={"Row": str})
+        placed = [(campaign, int(e), int(n), row) for e, n, row in plate_map[["Experiment Number", "Plate", "Row"]].itertuples(index=False)]
+        files = {str(e): CodeA.MULTIPLEX_FILE.format(plate_id=n) for c, e, n, row in placed}
+
+    rows, protocols = [], {}
+    instrument = CodeA.INSTRUMENT # Read once, so each stored protocol matches its hash and template version.
+    for experiment_id, params in CodeA.iter_params(table):
+        h = CodeA.params_hash(params, instrument)
+        rows.append((campaign, int(experiment_id), h, json.dumps(params), files.get(experiment_id, CodeA.protocol_filename(experiment_id))))
+        if h not in protocols:
+            protocols[h] = (h, CodeA.template_version(instrument), zlib.compress(CodeA.make_protocol_code(params, experiment_id, instrument).encode()))
+    known = {h for (h,) in con.execute("SELECT params_hash FROM protocols")}
+
+    with con:
+        con.execute("INSERT OR REPLACE INTO campaigns VALUES (?, ?, ?)", (campaign, os.path.abspath(design_csv), time.time()))
+        con.execute("DELETE FROM experiments WHERE campaign = ?", (campaign,))
+        con.executemany("INSERT INTO experiments VALUES (?, ?, ?, ?, ?)", rows)
+        con.execute("DELETE FROM plate_rows WHERE campaign = ?", (campaign,))
+        con.executemany("INSERT INTO plate_rows VALUES (?, ?, ?, ?)", placed)
+        con.executemany("INSERT INTO protocols VALUES (?, ?, ?)", [p for h, p in protocols.items() if h not in known])
+    return len(rows)
+
+
+def add_plates(con: sqlite3.Connection, campaign: str, data_dir: str = CodeC_incremental.DATA_DIR, prefix: str = None,
+               cache_dir: str = CodeC_ingest.CACHE_DIR):
+    # Stores the plate arrays of the campaign's fluorescence (<prefix>1.xlsx, ...) and absorbance (<prefix>1a.xlsx, ...) files,
+    # keyed by the plate number in the file name. This is the experiment id, except in row-multiplexed campaigns, where plate_rows
+    # gives the experiment of each row. Only files whose content hash has changed since they were stored are read.
+    prefix = prefix or campaign
+    stored = {(n, a): h for n, a, h in con.execute("SELECT plate, assay, file_hash FROM plates WHERE campaign = ?", (campaign,))}
+    index = CodeC_ingest.load_index(cache_dir) if os.path.isdir(cache_dir) else {}
+    rows = []
+    for suffix, assay in [("", "fluorescence"), ("a", "absorbance")]:
+        for number, path in CodeC_ingest.campaign_files(data_dir, prefix, suffix).items():
+            h = CodeC_ingest.fingerprint(path, index)
+            if stored.get((number, assay)) != h:
+                blocks, labels = CodeC_ingest.read_plate_cached(path, cache_dir, index)
+                rows.append((campaign, number, assay, os.path.basename(path), h, json.dumps(labels), _array_blob(blocks)))
+    CodeC_ingest.save_index(cache_dir, index)
+    with con:
+        con.executemany("INSERT OR REPLACE INTO plates VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+    return len(rows)
+
+
+def add_metrics(con: sqlite3.Connection, campaign: str, results_dir: str = CodeC_incremental.RESULTS_DIR, prefix: str = None):
+    # Stores the Code C results of the campaign (<prefix>_analysis.csv written by CodeC_analysis, or <prefix>_results.csv and
+    # <prefix>a_results.csv written by CodeC_incremental).
+    prefix = prefix or campaign
+    rows = []
+    results = CodeC_analysis.campaign_results(prefix, results_dir)
+    if len(results):
+        long = results.drop(columns=["Plate", "Row"], errors="ignore").melt(id_vars="Experiment Number", var_name="name") # The plate and row are in plate_rows.
+        rows = [(campaign, int(e), name, float(v)) for e, name, v in long.itertuples(index=False)]
+    with con:
+        con.executemany("INSERT OR REPLACE INTO metrics VALUES (?, ?, ?, ?)", rows)
+    return len(rows)
+
+
+def add_campaign(con: sqlite3.Connection, campaign: str, design_csv: str, data_dir: str = CodeC_incremental.DATA_DIR,
+                 results_dir: str = CodeC_incremental.RESULTS_DIR, manifest_path: str = None, prefix: str = None, plate_map: str = None):
+    # Stores everything about a campaign: its design and protocols, its plate files and its results. Give the plate map of a
+    # row-multiplexed campaign (CodeA.main_multiplex).
+    n = add_design(con, campaign, design_csv, manifest_path, plate_map)
+    plates = add_plates(con, campaign, data_dir, prefix)
+    metrics = add_metrics(con, campaign, results_dir, prefix)
+    print(f"{campaign}: {n} experiments, {plates} new or changed plates, {metrics} results")
+
+
+def query(con: sqlite3.Connection, campaigns: list = None, params_hash: str = None):
+    # One row per experiment with its campaign, id, parameter hash, resolved parameters and results, for the campaigns given
+    # (every campaign if None), or for the experiments which ran one parameter set. Experiments of row-multiplexed campaigns
+    # also have their Plate and Row.
+    where, args = [], []
+    if campaigns:
+        where.append(f"campaign IN ({', '.join('?' * len(campaigns))})")
+        args += list(campaigns)
+    if params_hash:
+        where.append("params_hash = ?")
+        args.append(params_hash)
+    clause = f" WHERE {' AND '.join(where)}" if where else ""
+
+    experiments = pd.read_sql_query(f"SELECT campaign, experiment_id, params_hash, params FROM experiments{clause}", con, params=args)
+    params = pd.DataFrame([json.loads(p) for p in experiments.pop("params")], index=experiments.index)
+    table = pd.concat([experiments, params], axis=1)
+
+    placed = pd.read_sql_query(f"SELECT campaign, experiment_id, plate AS Plate, row AS Row FROM plate_rows WHERE campaign IN (SELECT DISTINCT campaign FROM experiments{clause})",
+                               con, params=args)
+    if len(placed):
+        table = table.merge(placed, on=["campaign", "experiment_id"], how="left")
+
+    metrics = pd.read_sql_query(f"SELECT campaign, experiment_id, name, value FROM metrics WHERE campaign IN (SELECT DISTINCT campaign FROM experiments{clause})",
+                                con, params=args)
+    if len(metrics):
+        wide = metrics.pivot_table(index=["campaign", "experiment_id"], columns="name", values="value", aggfunc="last")
+        table = table.join(wide, on=["campaign", "experiment_id"])
+    return table.sort_values(["campaign", "experiment_id"]).reset_index(drop=True)
+
+
+def plate(con: sqlite3.Connection, campaign: str, experiment_id: int, assay: str = "fluorescence"):
+    # The stored plate array (blocks, 8, 11) of one experiment and its block labels. In a row-multiplexed campaign this is the
+    # whole plate the experiment shared; its row is in plate_rows (query gives it as Row).
+    placed = con.execute("SELECT plate FROM plate_rows WHERE campaign = ? AND experiment_id = ?", (campaign, experiment_id)).fetchone()
+    number = placed[0] if placed else experiment_id
+    row = con.execute("SELECT data, labels FROM plates WHERE campaign = ? AND plate = ? AND assay = ?",
+                      (campaign, number, assay)).fetchone()
+    if row is None:
+        raise KeyError(f"No {assay} plate stored for {campaign} experiment {experiment_id}")
+    return np.load(io.BytesIO(row[0])), json.loads(row[1])
+
+
+def protocol_code(con: sqlite3.Connection, params_hash: str): # The protocol stored for a parameter hash.
+    row = con.execute("SELECT code FROM protocols WHERE params_hash = ?", (params_hash,)).fetchone()
+    if row is None:
+        raise KeyError(f"No protocol stored for {params_hash}")
+    return zlib.decompress(row[0]).decode()
+
+
+def export_jmp(con: sqlite3.Connection, campaigns: list = None, out_csv: str = "campaigns_jmp.csv"):
+    # Writes the parameters and results of the campaigns as one table for JMP. Parameters which are the same in every row are left out.
+    table = query(con, campaigns)
+    constant = [k for k in CodeA.Default_Params if k in table and table[k].nunique() <= 1]
+    table = table.drop(columns=constant + ["params_hash"])
+    table.to_csv(out_csv, index=False)
+    print(f"Wrote {out_csv} ({len(table)} experiments)")
+    return table
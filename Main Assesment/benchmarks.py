@@ -0,0 +1,191 @@
+# Benchmarks of each stage of the pipeline, on synthetic designs and plate reader files.
+# Times protocol generation (Code A), plate ingestion, gradient/R2 fitting and the absorbance CV (Code C) at several design
+# sizes, and reports the time and peak memory of each stage. Save a run with --out and check a later run against it with
+# --baseline to catch regressions.
+#
+#   python benchmarks.py                          # 10, 1000 and 10000 experiments
+#   python benchmarks.py --sizes 10 1000 --out baseline.csv
+#   python benchmarks.py --sizes 10 1000 --baseline baseline.csv
+
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from itertools import repeat
+
+import numpy as np
+import pandas as pd
+from openpyxl import Workbook
+
+import CodeA
+import CodeC_fit
+import CodeC_incremental
+import CodeC_ingest
+
+SIZES = [10, 1000, 10000]
+FIXTURE_DIR = "bench_fixtures"    # Synthetic designs and workbooks are kept here and reused by later runs.
+N_BOOT = 1000
+TOLERANCE = 1.5                   # A stage more than this many times slower than the baseline is a regression.
+FLUOR_LABELS = ["Raw Data (485/520)"]  # Block labels of the synthetic plate files.
+ABS_LABELS = ["Raw Data (900)", "Raw Data (975)"]
+
+# Ranges of the factors varied in synthetic designs. Every other parameter is left to its default or inherited value.
+FACTOR_RANGES = {
+    "Aspiration_Rate": (0.5, 2.0),
+    "Dispense_Rate": (0.5, 2.0),
+    "Aspiration_Height": (0.5, 3.0),
+    "Dispense_Height": (0.5, 3.0),
+    "Mix_Aspiration_Height_Min": (0.5, 1.0),
+    "Mix_Aspiration_Height_Max": (1.0, 3.0),
+    "Mixing_Repetitions": (1, 5),
+    "Mixing_Fraction": (0.3, 0.9),
+    "Touch_Tip_Speed": (10, 60),
+}
+
+
+def synthetic_design(n: int, seed: int = 0): # A random design table with the columns of Default_Params, as exported from JMP.
+    rng = np.random.default_rng(seed)
+    design = {}
+    for k, (lo, hi) in FACTOR_RANGES.items():
+        if isinstance(CodeA.Default_Params[k], int):
+            design[k] = rng.integers(lo, hi + 1, size=n)
+        else:
+            design[k] = rng.uniform(lo, hi, size=n).round(2)
+    return pd.DataFrame(design)
+
+
+def synthetic_plates(n: int, blocks: int = 1, seed=0):
+    # Plate reader values of shape (n, blocks, 8, 11). Block 0 is a fluorescence dilution series with a per-plate gradient
+    # error, column bias and well noise. For absorbance (blocks=2) the blocks are the 900 nm and 975 nm readings of the wells.
+    rng = np.random.default_rng(seed)
+    if blocks == 1:
+        gradient = rng.normal(1.0, 0.05, size=(n, 1, 1, 1))
+        signal = 20000 * (CodeC_fit.FLUOR_CONC / 10) ** gradient
+        return signal * rng.normal(1, 0.03, size=(n, 1, 1, 11)) * rng.normal(1, 0.02, size=(n, 1, 8, 11))
+    volume = 100 * rng.normal(1, 0.05, size=(n, 1, 8, 11))
+    return np.concatenate([0.04 + 0.0001 * volume, 0.04 + 0.0006 * volume], axis=1) * rng.normal(1, 0.01, size=(n, 2, 8, 11))
+
+
+def write_workbook(path: str, blocks: np.ndarray, labels: list):
+    # Writes plate blocks in the FLUOstar 'End point' layout: 12 rows of run details, then for each block a label row, a header row
+    # with the column numbers and 8 rows A-H, so the first block has A1 in cell B15.
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(CodeC_ingest.SHEET_NAME)
+    for r in range(12):
+        ws.append([f"Run detail {r + 1}"])
+    for block, label in zip(blocks, labels):
+        ws.append([label])
+        ws.append([None] + list(range(1, 13)))
+        for row_name, row in zip("ABCDEFGH", block):
+            ws.append([row_name] + row.tolist() + [None])
+        ws.append([])
+    wb.save(path)
+
+
+def synthetic_workbooks(n: int, assay: str = "fluorescence", fixture_dir: str = FIXTURE_DIR, seed: int = 0):
+    # Writes n synthetic plate files (syn1.xlsx, ... or syn1a.xlsx, ... for absorbance) and returns their paths.
+    # Each file only depends on its number, so files which already exist are reused by runs of any size.
+    suffix, labels = ("", FLUOR_LABELS) if assay == "fluorescence" else ("a", ABS_LABELS)
+    data_dir = os.path.join(fixture_dir, f"{assay}_{seed}")
+    os.makedirs(data_dir, exist_ok=True)
+    paths = []
+    for i in range(1, n + 1):
+        path = os.path.join(data_dir, f"syn{i}{suffix}.xlsx")
+        if not os.path.exists(path):
+            write_workbook(path, synthetic_plates(1, len(labels), seed=[seed, i])[0], labels)
+        paths.append(path)
+    return paths
+
+
+def measure(fn, setup=None, memory: bool = True):
+    # Runs fn twice: once timed, and once under tracemalloc for its peak memory (tracemalloc slows Python code, so it is not timed).
+    if setup:
+        setup()
+    t0 = time.perf_counter()
+    fn()
+    seconds = time.perf_counter() - t0
+    peak = np.nan
+    if memory:
+        if setup:
+            setup()
+        tracemalloc.start()
+        fn()
+        peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+    return seconds, peak
+
+
+def run(sizes: list = SIZES, fixture_dir: str = FIXTURE_DIR, memory: bool = True, workers: int = None):
+    results = []
+    work = tempfile.mkdtemp(prefix="bench_")
+    try:
+        for n in sizes:
+            design_csv = os.path.join(fixture_dir, f"design_{n}.csv")
+            os.makedirs(fixture_dir, exist_ok=True)
+            if not os.path.exists(design_csv):
+                synthetic_design(n).to_csv(design_csv, index=False)
+
+            table = CodeA.load_design(design_csv)
+            out_dir = os.path.join(work, f"protocols_{n}")
+            cache_dir = os.path.join(work, f"cache_{n}")
+            fluor_paths = synthetic_workbooks(n, "fluorescence", fixture_dir)
+            abs_plates = synthetic_plates(n, 2)
+            fluor_plates = synthetic_plates(n, 1)[:, 0]
+
+            stages = [
+                ("resolve_design", lambda: CodeA.load_design(design_csv), None),
+                ("make_protocol_code", lambda: [CodeA.make_protocol_code(p, e) for e, p in CodeA.iter_params(table)], None),
+                ("main_parallel", lambda: quiet(CodeA.main_parallel, design_csv, out_dir, workers), lambda: shutil.rmtree(out_dir, ignore_errors=True)),
+                ("ingest_cold", lambda: CodeC_ingest.load_plates(fluor_paths, cache_dir), lambda: shutil.rmtree(cache_dir, ignore_errors=True)),
+                ("ingest_cached", lambda: CodeC_ingest.load_plates(fluor_paths, cache_dir), None),
+                ("fit_gradient_r2", lambda: CodeC_fit.fit_experiments(fluor_plates), None),
+                ("bootstrap_ci", lambda: CodeC_fit.bootstrap(fluor_plates, n_boot=N_BOOT), None),
+                ("absorbance_cv", lambda: CodeC_incremental.absorbance_metrics(zip(abs_plates, repeat(ABS_LABELS)), list(range(1, n + 1))), None),
+            ]
+            for stage, fn, setup in stages:
+                seconds, peak = measure(fn, setup, memory)
+                results.append({"stage": stage, "experiments": n, "seconds": seconds, "rows_per_sec": n / seconds, "peak_mib": peak})
+                print(f"{stage:<20} n={n:<6} {seconds:9.3f} s {n / seconds:12.0f} rows/sec {peak:9.1f} MiB peak")
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    return pd.DataFrame(results)
+
+
+def quiet(fn, *args): # Runs fn without its progress output.
+    with contextlib.redirect_stdout(io.StringIO()):
+        return fn(*args)
+
+
+def compare(results: pd.DataFrame, baseline_csv: str, tolerance: float = TOLERANCE):
+    # Returns the stages which are more than tolerance times slower than in the baseline run.
+    baseline = pd.read_csv(baseline_csv)
+    joined = results.merge(baseline, on=["stage", "experiments"], suffixes=("", "_baseline"))
+    joined["ratio"] = joined["seconds"] / joined["seconds_baseline"]
+    print(joined[["stage", "experiments", "seconds_baseline", "seconds", "ratio"]].to_string(index=False))
+    return joined[joined["ratio"] > tolerance]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the protocol generation and analysis stages.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="numbers of experiments")
+    parser.add_argument("--fixtures", default=FIXTURE_DIR, help="directory for the synthetic designs and workbooks")
+    parser.add_argument("--workers", type=int, default=None, help="processes for main_parallel")
+    parser.add_argument("--no-memory", action="store_true", help="skip the peak memory measurement")
+    parser.add_argument("--out", help="save the results as a CSV baseline")
+    parser.add_argument("--baseline", help="compare against a saved baseline CSV")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    args = parser.parse_args()
+
+    results = run(args.sizes, args.fixtures, not args.no_memory, args.workers)
+    if args.out:
+        results.to_csv(args.out, index=False)
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        if len(regressions):
+            print(f"{len(regressions)} stages are more than {args.tolerance}x slower than the baseline")
+            sys.exit(1)